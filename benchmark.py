@@ -0,0 +1,1373 @@
+import time
+import os
+import argparse
+import tempfile
+import threading
+import json
+import logging
+import sys
+import random
+import shutil
+import fitz
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import summarize
+
+
+# every measurement of the run, written to --output as JSON so runs of two commits can be compared
+RESULTS = []
+
+
+def report(case, metric, value, unit, **labels):
+    RESULTS.append(dict(labels, case=case, metric=metric, value=float(value), unit=unit))
+
+
+def random_body(rng, size=3300, edits=0):
+    # random words of a fixed vocabulary; the same rng state gives the same page, and edits
+    # replaces a few words of it, like a revised version of the paper
+    words = []
+    while sum(len(word) + 1 for word in words) < size:
+        words.append("w{}".format(rng.randrange(5000)))
+    edit_rng = random.Random(rng.random())
+    for _ in range(edits):
+        words[edit_rng.randrange(len(words))] = "edit{}".format(edit_rng.randrange(5000))
+    return " ".join(words)
+
+
+def make_synthetic_pdf(file_name, num_pages=40, reference_pages=0, seed=None, edits=0, outline=True):
+    doc = fitz.open()
+    conclusion_page = num_pages - reference_pages - 1
+    body = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor " * 14 + "\n") * 3
+    rng = random.Random(seed)
+    for page_index in range(num_pages):
+        if seed is not None:
+            body = random_body(rng, edits=edits)
+        page = doc.new_page()
+        if page_index == 0:
+            page.insert_text((72, 80), "A Synthetic Paper For Benchmarking", fontsize=20)
+            page.insert_text((72, 110), "Jane Doe, John Roe", fontsize=11)
+            page.insert_text((72, 140), "Abstract", fontsize=12)
+            page.insert_text((72, 160), "We study synthetic documents.", fontsize=10)
+            page.insert_text((72, 190), "Introduction", fontsize=12)
+        elif page_index == 1:
+            page.insert_text((72, 190), "Method", fontsize=12)
+        elif page_index == conclusion_page:
+            page.insert_text((72, 190), "Conclusion", fontsize=12)
+        elif reference_pages and page_index == conclusion_page + 1:
+            page.insert_text((72, 190), "References", fontsize=12)
+        assert page.insert_textbox(fitz.Rect(72, 210, 540, 780), body, fontsize=9) >= 0
+    toc = [[1, "Introduction", 1], [1, "Method", 2], [1, "Conclusion", conclusion_page + 1]]
+    if reference_pages:
+        toc.append([1, "References", conclusion_page + 2])
+    if outline:
+        doc.set_toc(toc)
+    doc.save(file_name)
+    doc.close()
+
+
+HEADING_STYLES = {
+    "plain": lambda number, name: name,
+    "numbered": lambda number, name: "{} {}".format(number, name),
+    "roman": lambda number, name: "{}. {}".format(summarize.ROMAN_NUM[number - 1], name.upper()),
+    "upper": lambda number, name: name.upper(),
+}
+STYLED_SECTIONS = ["Introduction", "Method", "Experiments", "Conclusion"]
+
+
+def make_styled_pdf(file_name, num_pages=12, style="plain", images=0, title_size=20, title_lines=1):
+    # one paper of the corpus: heading style, page count, figures and title font size vary
+    import io
+    from PIL import Image
+    rng = np.random.default_rng(num_pages)
+    heading = HEADING_STYLES[style]
+    body = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor " * 14 + "\n") * 3
+    section_pages = {0: 1, 1: 2, num_pages // 2: 3, num_pages - 1: 4}
+    doc = fitz.open()
+    for page_index in range(num_pages):
+        page = doc.new_page()
+        if page_index == 0:
+            for line in range(title_lines):
+                page.insert_text((72, 50 + line * (title_size + 4)), "Synthetic {} Paper Of {} Pages Part {}".format(style.title(), num_pages, line + 1),
+                                 fontsize=title_size)
+            page.insert_text((72, 120), "Jane Doe, John Roe", fontsize=11)
+            page.insert_text((72, 140), "Abstract" if style in ("plain", "numbered") else "ABSTRACT", fontsize=12)
+            page.insert_text((72, 160), "We study synthetic documents.", fontsize=10)
+        elif page_index <= images:
+            pixels = rng.integers(0, 255, (300 + 40 * page_index, 400, 3), dtype=np.uint8)
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+            page.insert_image(fitz.Rect(72, 20, 540, 180), stream=buffer.getvalue())
+        if page_index in section_pages:
+            number = section_pages[page_index]
+            page.insert_text((72, 190), heading(number, STYLED_SECTIONS[number - 1]), fontsize=12)
+        assert page.insert_textbox(fitz.Rect(72, 210, 540, 780), body, fontsize=9) >= 0
+    doc.save(file_name)
+    doc.close()
+
+
+def make_corpus(root):
+    # (file name, pages, heading style, images, title size, title lines)
+    corpus = []
+    for index, (num_pages, style, images, title_size, title_lines) in enumerate([
+            (8, "plain", 0, 20, 1), (12, "numbered", 2, 16, 1), (24, "roman", 0, 24, 2),
+            (40, "upper", 4, 18, 1), (80, "numbered", 1, 22, 2), (12, "roman", 3, 14, 1)]):
+        path = os.path.join(root, "corpus-{}-{}-{}.pdf".format(index, style, num_pages))
+        make_styled_pdf(path, num_pages=num_pages, style=style, images=images,
+                        title_size=title_size, title_lines=title_lines)
+        corpus.append((path, num_pages, style, images, title_size, title_lines))
+    return corpus
+
+
+def timed(func, repeat):
+    start_time = time.time()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.time() - start_time) / repeat
+
+
+def make_image_pdf(file_name, num_pages=20, images_per_page=4, side=1600):
+    # figure-heavy paper: large noisy JPEGs, one of them reused on every page
+    import io
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+
+    def jpeg(width, height):
+        pixels = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+    doc = fitz.open()
+    logo = jpeg(300, 200)
+    for page_index in range(num_pages):
+        page = doc.new_page()
+        page.insert_image(fitz.Rect(20, 20, 120, 80), stream=logo)
+        for image_index in range(images_per_page):
+            width = side - 40 * ((page_index * images_per_page + image_index) % 17)
+            top = 100 + image_index * 170
+            page.insert_image(fitz.Rect(72, top, 540, top + 160), stream=jpeg(width, width * 3 // 4))
+    doc.save(file_name)
+    doc.close()
+
+
+def legacy_image_path(path, image_path):
+    # what get_image_path used to do: extract every embedded image and keep them all open
+    import io
+    from PIL import Image
+    max_size = 0
+    image_list = []
+    with fitz.Document(path) as my_pdf_file:
+        for page in my_pdf_file:
+            for image in page.get_images():
+                base_image = my_pdf_file.extract_image(image[0])
+                image = Image.open(io.BytesIO(base_image["image"]))
+                max_size = max(max_size, image.size[0] * image.size[1])
+                image_list.append(image)
+    for image in image_list:
+        if image.size[0] * image.size[1] == max_size:
+            image = image.resize((480, 360))
+            image.save(os.path.join(image_path, "image.jpeg"))
+            return
+
+
+def run_image_case(name, path, out_dir, result_queue):
+    import resource
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    if name == "before":
+        legacy_image_path(path, out_dir)
+    else:
+        paper = summarize.Paper(path=path, title="images")
+        paper.get_image_path(out_dir)
+    cost = time.time() - start_time
+    result_queue.put((cost, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024))
+
+
+def bench_image(args):
+    import multiprocessing
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "images.pdf")
+        make_image_pdf(path, num_pages=args.pages // 3 or 1)
+        for name in ("before", "after"):
+            # a fresh process per case, so peak RSS is not shared between them
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_image_case, args=(name, path, tmp_dir, result_queue))
+            process.start()
+            cost, peak_mb = result_queue.get()
+            process.join()
+            report("image", "seconds", cost, "s", variant=name)
+            report("image", "peak_memory", peak_mb, "MB", variant=name)
+            print("get_image_path {}: {:.2f}s, peak memory +{:.0f} MB".format(name, cost, peak_mb))
+
+        # a paper read back from the parsed paper cache knows its largest image without scanning
+        path = os.path.join(tmp_dir, "figures.pdf")
+        make_styled_pdf(path, num_pages=6, images=3)
+        expected = summarize.Paper(path=path)
+        expected.get_image_path(tmp_dir)
+        cache_root = os.path.join(tmp_dir, "papers")
+        summarize.PaperCache(cache_root).get_paper(path)
+        cached = summarize.PaperCache(cache_root).get_paper(path)
+        assert cached.largest_image and cached.largest_image == expected.largest_image, cached.largest_image
+        image_path, ext = cached.get_image_path(tmp_dir)
+        assert os.path.exists(image_path), image_path
+        print("get_image_path of a cached paper: largest image {width}x{height} on page {page}".format(**cached.largest_image))
+
+
+def legacy_extraction(path):
+    # the passes the parser used to make: get_title() read every page as "dict" twice,
+    # then parse_pdf / _get_all_page_index / _get_all_page read plain text three times
+    doc = fitz.open(path)
+    for _ in range(2):
+        for page in doc:
+            page.get_text("dict")
+    for _ in range(3):
+        [page.get_text() for page in doc]
+    doc.close()
+
+
+def single_pass_extraction(path):
+    with fitz.open(path) as doc:
+        summarize.extract_pages(doc)
+
+
+def bench(func, path, num_pages, repeat):
+    start_time = time.time()
+    for _ in range(repeat):
+        func(path)
+    cost = time.time() - start_time
+    return num_pages * repeat / cost
+
+
+def bench_extraction(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "synthetic.pdf")
+        make_synthetic_pdf(path, num_pages=args.pages)
+        before = bench(legacy_extraction, path, args.pages, args.repeat)
+        after = bench(single_pass_extraction, path, args.pages, args.repeat)
+    report("extraction", "pages_per_second", before, "pages/s", variant="before")
+    report("extraction", "pages_per_second", after, "pages/s", variant="after")
+    print("extraction pages/s before: {:.1f}".format(before))
+    print("extraction pages/s after:  {:.1f}".format(after))
+    print("speedup: {:.2f}x".format(after / before))
+
+
+# (document text, section names the segmenter should find, in document order)
+SEGMENT_CORPUS = [
+    ("Title\nAbstract\nWe study x.\n1 Introduction\nText.\n2 Method\nSteps.\n3 Conclusion\nDone.\nReferences\n[1] a\n",
+     ["Abstract", "Introduction", "Method", "Conclusion", "References"]),
+    ("ABSTRACT—We study x.\nI. INTRODUCTION\nText about the Method\nII. RELATED WORK\nIII. APPROACH\nIV. EXPERIMENTS\nV. CONCLUSION\nREFERENCES\n",
+     ["Abstract", "Introduction", "Related Work", "Approach", "Experiments", "Conclusion", "References"]),
+    ("Abstract. Short.\nIntroduction\npage one ends\npage two starts\nMaterials and methods\nResults and Discussion\nConclusion\n",
+     ["Abstract", "Introduction", "Materials and Methods", "Results and Discussion", "Conclusion"]),
+    ("no headings here, only Introduction in a sentence\nand the Results\n", []),
+]
+
+
+def check_segments():
+    segmenter = summarize.SectionSegmenter()
+    for text, expected in SEGMENT_CORPUS:
+        spans = segmenter.segment(text)
+        assert list(spans) == expected, (list(spans), expected)
+        previous_end = None
+        for section_name, (start, end) in spans.items():
+            assert text[start:end].lower().startswith(section_name.lower()[:6]), text[start:end]
+            assert previous_end is None or text[previous_end:start].strip(" .IVX0123456789\n") == ''
+            previous_end = end
+        if spans:
+            assert previous_end == len(text)
+    print("segment corpus: {} documents ok".format(len(SEGMENT_CORPUS)))
+
+
+def bench_segmentation(args):
+    check_segments()
+    segmenter = summarize.SectionSegmenter()
+    text = ''.join(text for text, _ in SEGMENT_CORPUS) + "Lorem ipsum dolor sit amet\n" * 2000
+    for scale in (1, 4, 16):
+        doc_text = text * scale
+        start_time = time.time()
+        for _ in range(args.repeat):
+            segmenter.segment(doc_text)
+        cost = (time.time() - start_time) / args.repeat
+        report("segmentation", "seconds", cost, "s", chars=len(doc_text))
+        print("segmentation {:>9} chars: {:.2f} ms ({:.1f} MB/s)".format(len(doc_text), cost * 1000, len(doc_text) / cost / 1e6))
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # serves files from server.root with Range support and a fixed latency per request
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.requests += 1
+        path = os.path.join(self.server.root, os.path.basename(self.path))
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as file:
+            data = file.read()
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server(root, latency=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    server.root = root
+    server.latency = latency
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_download(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fixture_dir = os.path.join(tmp_dir, "fixtures")
+        out_dir = os.path.join(tmp_dir, "out")
+        os.makedirs(fixture_dir)
+        os.makedirs(out_dir)
+        make_synthetic_pdf(os.path.join(fixture_dir, "paper.pdf"), num_pages=args.pages)
+        server = start_fixture_server(fixture_dir, latency=args.latency)
+        url = "http://127.0.0.1:{}/paper.pdf".format(server.server_address[1])
+        expected = open(os.path.join(fixture_dir, "paper.pdf"), 'rb').read()
+
+        # a partial file from an interrupted run is resumed, not downloaded again
+        file_name = os.path.join(out_dir, "resume.pdf")
+        with open(file_name + '.part', 'wb') as file:
+            file.write(expected[:len(expected) // 3])
+        summarize.download_pdf(url, file_name)
+        assert open(file_name, 'rb').read() == expected
+
+        # a 404 is final: one request, no backoff
+        import requests
+        server.requests = 0
+        try:
+            summarize.download_pdf(url.replace("paper.pdf", "missing.pdf"), os.path.join(out_dir, "missing.pdf"))
+            raise AssertionError("downloaded a missing file")
+        except requests.HTTPError:
+            pass
+        assert server.requests == 1, server.requests
+
+        for workers in (1, args.download_workers):
+            downloader = summarize.PdfDownloader(max_workers=workers, per_host=workers)
+            start_time = time.time()
+            futures = [downloader.submit(url, os.path.join(out_dir, "{}-{}.pdf".format(workers, i)))
+                       for i in range(args.papers)]
+            for future in futures:
+                assert open(future.result(), 'rb').read() == expected
+            cost = time.time() - start_time
+            downloader.close()
+            report("download", "seconds", cost, "s", papers=args.papers, workers=workers)
+            print("download {} papers with {} workers: {:.2f}s".format(args.papers, workers, cost))
+        server.shutdown()
+
+
+def bench_parse(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for paper_index in range(args.papers):
+            path = os.path.join(tmp_dir, "paper-{}.pdf".format(paper_index))
+            make_synthetic_pdf(path, num_pages=args.pages)
+            paths.append(path)
+        with open(os.path.join(tmp_dir, "broken.pdf"), 'wb') as file:
+            file.write(b"%PDF-1.4 not really a pdf")
+        paths.append(os.path.join(tmp_dir, "broken.pdf"))
+        # like a scan: no span is long enough for a title, so the parsed title is ''
+        doc = fitz.open()
+        for page_index in range(3):
+            page = doc.new_page()
+            for line in range(40):
+                page.insert_text((72, 72 + 15 * line), "ab c", fontsize=10)
+        doc.save(os.path.join(tmp_dir, "untitled.pdf"))
+        doc.close()
+        paths.append(os.path.join(tmp_dir, "untitled.pdf"))
+        parse_pdf = summarize.Paper.parse_pdf
+        parsed = []
+
+        def counting_parse_pdf(paper):
+            parsed.append(paper.path)
+            return parse_pdf(paper)
+        for workers in sorted({1, args.workers}):
+            del parsed[:]
+            summarize.Paper.parse_pdf = counting_parse_pdf
+            start_time = time.time()
+            try:
+                paper_list = summarize.parse_papers(paths, workers=workers)
+            finally:
+                summarize.Paper.parse_pdf = parse_pdf
+            cost = time.time() - start_time
+            assert len(paper_list) == args.papers + 1
+            assert paper_list[-1].title == ''
+            # worker processes parse, the parent only rebuilds their results, untitled ones included
+            assert len(parsed) == (len(paper_list) if workers == 1 else 0), parsed
+            report("parse", "seconds", cost, "s", papers=args.papers, workers=workers)
+            print("parse {} papers with {} processes: {:.2f}s ({:.1f} papers/s)".format(
+                args.papers, workers, cost, args.papers / cost))
+
+
+class FakeResult:
+    def __init__(self, index, summary):
+        self.title = "Paper {}".format(index)
+        self.updated = index
+        self.summary = summary
+        self.entry_id = "http://arxiv.org/abs/0000.{:05d}v1".format(index)
+
+
+class FakeSearch:
+    # stands in for arxiv.Search: every result costs a little latency, like a paged feed
+    def __init__(self, num_results, latency):
+        self.num_results = num_results
+        self.latency = latency
+
+    def results(self):
+        for index in range(self.num_results):
+            time.sleep(self.latency)
+            topic = "deep reinforcement learning" if index % 3 == 0 else "graph neural\nnetworks"
+            yield FakeResult(index, "We study " + topic + " on synthetic bench-\nmarks. " * 20)
+
+
+def legacy_filter(search, filter_keys):
+    for result in search.results():
+        pass
+    filter_results = []
+    for result in search.results():
+        abs_text = result.summary.replace('-\n', '-').replace('\n', ' ')
+        meet_num = 0
+        for f_key in filter_keys.split(" "):
+            if f_key.lower() in abs_text.lower():
+                meet_num += 1
+        if meet_num == len(filter_keys.split(" ")):
+            filter_results.append(result)
+    return filter_results
+
+
+def bench_filter(args):
+    filter_keys = "reinforcement learning deep"
+    search = FakeSearch(args.papers * 3, latency=args.latency / 20)
+    start_time = time.time()
+    expected = legacy_filter(search, filter_keys)
+    legacy_cost = time.time() - start_time
+
+    start_time = time.time()
+    first_match = None
+    matched = []
+    for result in summarize.filter_results(search.results(), summarize.KeywordFilter(filter_keys)):
+        if first_match is None:
+            first_match = time.time() - start_time
+        matched.append(result)
+    cost = time.time() - start_time
+    assert [r.title for r in matched] == [r.title for r in expected]
+    report("filter", "first_match_seconds", first_match, "s", results=search.num_results)
+    report("filter", "seconds", cost, "s", results=search.num_results)
+    print("filter {} results: before {:.2f}s (first match after {:.2f}s), after {:.2f}s (first match after {:.2f}s)".format(
+        search.num_results, legacy_cost, legacy_cost, cost, first_match))
+
+    # --watch sorted by update date: a scan cut off by max_results keeps the watermark, so the entries
+    # it did not get to are handled by a later run instead of being paged past
+    import datetime
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint = summarize.Checkpoint(os.path.join(tmp_dir, "watch.json"))
+        results = []
+        for day in range(1, 41):
+            result = FakeResult(day, "")
+            result.updated = datetime.datetime(2024, 1, 1) + datetime.timedelta(days=day)
+            results.append(result)
+        results.reverse()
+        handled = []
+        # newest first: a run over the 10 oldest entries, then two after 30 newer ones appeared
+        for entries, max_results in ((results[30:], 10), (results, 10), (results, 40)):
+            done = {result.entry_id: result.updated.isoformat()
+                    for result in checkpoint.unseen(entries[:max_results], stop_early=True, max_results=max_results)}
+            checkpoint.commit(done)
+            handled.extend(done)
+        assert sorted(handled) == sorted(result.entry_id for result in results), len(handled)
+        print("watch: 30 new entries over --max_results 10, all handled by the next run with --max_results 40")
+
+
+def make_abstracts(num_results, seed=0):
+    rng = random.Random(seed)
+    words = ["model", "data", "method", "results", "network", "graph", "policy", "reward", "agent",
+             "training", "learning", "optimization", "benchmark", "robust", "transformer", "language",
+             "vision", "control", "sample", "efficient"] + ["term{}".format(index) for index in range(3000)]
+    topics = ["deep reinforcement learning", "reinforcement learning", "deep learning", "graph neural networks"]
+    results = []
+    for index in range(num_results):
+        text = [rng.choice(words) for _ in range(rng.randint(80, 250))]
+        for _ in range(rng.randint(0, 3)):
+            text.insert(rng.randrange(len(text)), rng.choice(topics))
+        results.append(FakeResult(index, " ".join(text)))
+    return results
+
+
+def bench_rank(args):
+    results = make_abstracts(args.papers * 200)
+    query = "deep reinforcement learning reinforcement learning"
+    start_time = time.time()
+    for _ in range(args.repeat):
+        index = summarize.BM25Index([result.summary for result in results])
+    index_cost = (time.time() - start_time) / args.repeat
+    start_time = time.time()
+    for _ in range(args.repeat):
+        scores = index.score(query)
+    score_cost = (time.time() - start_time) / args.repeat
+    # the best ranked abstracts must contain the query terms the substring filter looks for
+    kept = list(summarize.rank_results(results, query, top_k=10))
+    keyword_filter = summarize.KeywordFilter("reinforcement learning")
+    assert all(keyword_filter.match(result.summary) for result in kept)
+    assert scores.max() == scores[int(kept[0].entry_id[-7:-2])]
+    report("rank", "index_seconds", index_cost, "s", abstracts=len(results))
+    report("rank", "score_seconds", score_cost, "s", abstracts=len(results))
+    print("rank {} abstracts: index {:.3f}s, score {:.4f}s, {} matched the plain filter".format(
+        len(results), index_cost, score_cost, sum(keyword_filter.match(result.summary) for result in results)))
+
+
+def bench_tokenize(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "synthetic.pdf")
+        make_synthetic_pdf(path, num_pages=args.pages)
+        paper = summarize.Paper(path=path)
+    sections = list(paper.section_text_dict)
+    header = "Title:" + paper.title + "Paper_info:" + paper.section_text_dict['paper_info']
+    answer = "1. Title: xxx " * 40
+
+    # before: every chat call re-encoded its whole input and guessed a character cut
+    encoding = summarize.load_encoding("gpt-3.5-turbo", TOKENIZER_CACHE_DIR)
+    start_time = time.time()
+    for _ in range(args.repeat):
+        for text in (header + paper.section_text_dict[sections[0]],
+                     answer + paper.section_text_dict[sections[-1]],
+                     answer + answer + paper.section_text_dict[sections[-1]]):
+            text_token = len(encoding.encode(text))
+            text[:int(len(text) * (4096 - 1000) / text_token)]
+    before = (time.time() - start_time) / args.repeat
+
+    budget = summarize.TokenBudget("gpt-3.5-turbo", 4096, TOKENIZER_CACHE_DIR)
+    start_time = time.time()
+    for _ in range(args.repeat):
+        paper.section_tokens = {}
+        budget.clip('summary', [header, budget.section_tokens(paper, sections[0])], 1000)
+        budget.clip('method', [answer, budget.section_tokens(paper, sections[-1])], 1000)
+        clip_text = budget.clip('conclusion', [answer + answer, budget.section_tokens(paper, sections[-1])], 1000)
+    after = (time.time() - start_time) / args.repeat
+    assert len(budget.encode(clip_text)) <= 4096 - 1000
+    report("tokenize", "seconds", before, "s", variant="before")
+    report("tokenize", "seconds", after, "s", variant="after")
+    print("tokenization per paper: before {:.1f} ms, after {:.1f} ms".format(before * 1000, after * 1000))
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    # answers POST /chat/completions like the OpenAI API, after server.latency seconds
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        api_key = self.headers.get('Authorization', '').replace('Bearer ', '')
+        with self.server.lock:
+            # server.rpm requests per key in any one-second window, like a compressed rate limit
+            now = time.time()
+            window = [t for t in self.server.key_calls.get(api_key, []) if now - t < 1.0]
+            limited = self.server.rpm and len(window) >= self.server.rpm
+            if not limited:
+                window.append(now)
+                self.server.calls += 1
+            self.server.key_calls[api_key] = window
+        if limited:
+            body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": None, "param": None}}).encode('utf-8')
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('retry-after', '1')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if request.get("stream"):
+            self.stream_answer(request)
+            return
+        time.sleep(self.server.latency)
+        prompt_tokens = sum(len(message["content"].split()) for message in request["messages"])
+        content = "fake answer for a prompt of {} words".format(prompt_tokens)
+        if "JSON" in request["messages"][-1]["content"]:
+            content = json.dumps({"title": "Fake", "authors": ["A", "B"], "affiliation": "Nowhere", "keywords": ["x"],
+                                  "urls": "Github:None", "summary": [content] * 4, "methods": [content] * 3,
+                                  "conclusion": {"significance": content, "innovation": "x", "performance": "y", "workload": "z"}})
+        body = json.dumps({
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 8, "total_tokens": prompt_tokens + 8},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('openai-processing-ms', str(int(self.server.latency * 1000)))
+        if self.server.rpm:
+            self.send_header('x-ratelimit-limit-requests', str(self.server.rpm))
+            self.send_header('x-ratelimit-remaining-requests', str(self.server.rpm - len(window)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_answer(self, request):
+        # server-sent events, one word per chunk, the latency spread over the whole answer
+        words = ("fake streamed answer line\n" * 8).split(' ')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('openai-processing-ms', '1')
+        self.end_headers()
+        with self.server.lock:
+            broken = self.server.broken_streams > 0
+            self.server.broken_streams -= broken
+        for index, word in enumerate(words):
+            if broken and index == len(words) // 2:
+                # the connection fails halfway through the answer
+                error = {"error": {"message": "stream interrupted", "type": "server_error", "param": None, "code": None}}
+                self.wfile.write(("data: " + json.dumps(error) + "\n\n").encode('utf-8'))
+                self.close_connection = True
+                return
+            time.sleep(self.server.latency / len(words))
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": request["model"],
+                     "choices": [{"index": 0, "delta": {"content": word + ' '}, "finish_reason": None}]}
+            self.wfile.write(("data: " + json.dumps(chunk) + "\n\n").encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_completion_server(latency=0.0, rpm=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCompletionHandler)
+    server.latency = latency
+    server.rpm = rpm
+    server.key_calls = {}
+    server.calls = 0
+    server.broken_streams = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_reader(tmp_dir, server, *options):
+    argv = ["--api_key", "fake", "--api_base", "http://127.0.0.1:{}".format(server.server_address[1]),
+            "--no_cache", "--tiktoken_cache_dir", TOKENIZER_CACHE_DIR] + list(options)
+    args = summarize.get_parser().parse_args(argv)
+    return summarize.Reader(key_word=args.key_word, query=args.query, filter_keys=args.filter_keys,
+                            root_path=tmp_dir + '/', args=args)
+
+
+def bench_map_reduce(args):
+    server = start_completion_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "synthetic.pdf")
+        make_synthetic_pdf(path, num_pages=args.pages)
+        paper = summarize.Paper(path=path)
+        for chunk_workers in sorted({1, args.chunk_workers}):
+            reader = make_reader(tmp_dir, server, "--map_reduce", "--chunk_workers", str(chunk_workers),
+                                 "--max_calls_per_paper", str(args.max_calls))
+            server.calls = 0
+            start_time = time.time()
+            reader.summarize_paper(0, paper)
+            cost = time.time() - start_time
+            assert server.calls <= args.max_calls
+            report("map_reduce", "seconds", cost, "s", chunk_workers=chunk_workers, calls=server.calls)
+            print("map_reduce with {} chunk workers: {} calls in {:.2f}s".format(chunk_workers, server.calls, cost))
+
+        # with a prefix leaving room for only 60 tokens, the joined chunk summaries are condensed again
+        budget = reader.token_budget
+        full = budget.budget('method', reader.method_prompt_token)
+        prefix = budget.encoding.decode(budget.encode("x " * full)[:full - 60])
+        tokens = budget.section_tokens(paper, list(paper.section_text_dict)[-1])
+        server.calls = 0
+        text, calls = reader.condense_tokens(prefix, tokens, 'method', reader.method_prompt_token, args.max_calls)
+        first_level = len(budget.split(tokens, budget.budget('chunk', reader.chunk_prompt_token), reader.chunk_overlap))
+        assert len(budget.encode(text)) <= 60 and first_level < calls == server.calls <= args.max_calls, (calls, first_level)
+        print("map_reduce: {} chunk summaries over the budget were reduced again, {} calls in all".format(first_level, calls))
+    server.shutdown()
+
+
+def bench_keys(args):
+    rpm = 5
+    server = start_completion_server(latency=args.latency / 4, rpm=rpm)
+    messages = [{"role": "user", "content": "hello"}]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_keys in (1, 3):
+            api_keys = ",".join("key-{}".format(index) for index in range(num_keys))
+            reader = make_reader(tmp_dir, server, "--api_key", api_keys)
+            # the same limit as the server, on a one-second instead of one-minute window
+            reader.key_pool = summarize.KeyPool(reader.chat_api_list, rpm=rpm, tpm=10 ** 6, period=1.0)
+            start_time = time.time()
+            with summarize.ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda _: reader.chat_completion(messages), range(args.papers)))
+            cost = time.time() - start_time
+            report("keys", "calls_per_second", args.papers / cost, "calls/s", keys=num_keys)
+            print("{} calls with {} keys: {:.2f}s ({:.1f} calls/s)".format(args.papers, num_keys, cost, args.papers / cost))
+    server.shutdown()
+
+
+def bench_summary_modes(args):
+    server = start_completion_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "synthetic.pdf")
+        make_synthetic_pdf(path, num_pages=args.pages)
+        paper = summarize.Paper(path=path)
+        for mode in ("chain", "combined"):
+            reader = make_reader(tmp_dir, server, "--summary_mode", mode)
+            file_name = reader.summarize_paper(0, paper)
+            assert "8. Conclusion" in open(file_name, encoding='utf-8').read() or mode == "chain"
+            reader.show_run_summary()
+    server.shutdown()
+
+
+def bench_stream(args):
+    server = start_completion_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "synthetic.pdf")
+        make_synthetic_pdf(path, num_pages=args.pages)
+        paper = summarize.Paper(path=path)
+        contents = []
+        for options in ([], ["--stream"]):
+            reader = make_reader(tmp_dir, server, *options)
+            file_name = reader.summarize_paper(0, paper)
+            contents.append(open(file_name, encoding='utf-8').read())
+            stats = reader.paper_stats[0]
+            report("stream", "first_token_seconds", stats['first_token'], "s", stream=bool(options))
+            print("{}: time to first token {:.2f}s, paper {:.2f}s".format(
+                "stream" if options else "no stream", stats['first_token'], stats['seconds']))
+        assert contents[0].count('\n') > 0 and contents[1].startswith(contents[0][:20])
+
+        # an answer that fails halfway is retried from the start, without its first half left in the export
+        import tenacity
+        retrying = summarize.Reader.chat_summary.retry
+        wait, retrying.wait = retrying.wait, tenacity.wait_none()
+        server.broken_streams = 1
+        try:
+            file_name = make_reader(tmp_dir, server, "--stream").summarize_paper(0, paper)
+        finally:
+            retrying.wait = wait
+        assert open(file_name, encoding='utf-8').read() == contents[1], "a broken stream left text in the export"
+        print("stream: an answer broken halfway was retried without leaving its partial text in the export")
+    server.shutdown()
+
+
+def bench_dedup(args):
+    server = start_completion_server(latency=args.latency / 4)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        papers = []
+        for name, seed, edits in (("paper-v1", 1, 0), ("paper-v2", 1, 3), ("other", 2, 0)):
+            path = os.path.join(tmp_dir, name + ".pdf")
+            make_synthetic_pdf(path, num_pages=args.pages // 4, seed=seed, edits=edits)
+            paper = summarize.Paper(path=path, title=name)
+            paper.parse_pdf()
+            papers.append(paper)
+        reader = make_reader(tmp_dir, server, "--dedup")
+        calls = []
+        for paper_index, paper in enumerate(papers):
+            server.calls = 0
+            reader.summarize_paper(paper_index, paper)
+            calls.append(server.calls)
+        assert calls[0] == 3 and calls[1] == 0 and calls[2] == 3, calls
+        report("dedup", "chat_calls", sum(calls), "calls", papers=len(calls))
+        print("dedup: chat calls per paper {} (v1, v2, other)".format(calls))
+
+        # lookups only read their own buckets, so they stay flat while the archive grows
+        index = reader.duplicates
+        signature = index.signature(papers[1])
+        rng = np.random.RandomState(0)
+        for archive_size in (10, 1000, 10000):
+            while len(index.db.execute("SELECT id FROM papers").fetchall()) < archive_size:
+                index.add(rng.randint(0, 1 << 32, size=signature.size).astype(np.uint64), papers[2], "", "")
+            start_time = time.time()
+            for _ in range(args.repeat * 10):
+                assert index.find(signature)['title'] == "paper-v1"
+            report("dedup", "lookup_seconds", (time.time() - start_time) / (args.repeat * 10), "s", archived=archive_size)
+            print("dedup lookup with {} archived papers: {:.2f}ms".format(
+                archive_size, (time.time() - start_time) / (args.repeat * 10) * 1000))
+        index.close()
+    server.shutdown()
+
+
+class StoredPaper:
+    # what SummaryStore.add reads from a Paper
+    def __init__(self, result):
+        self.url = result.entry_id
+        self.path = ""
+        self.title = result.title
+        self.authors = ["Author {}".format(result.updated % 50)]
+
+
+def fill_store(store, results):
+    stats = {'mode': 'chain', 'calls': 3, 'prompt_tokens': 3000, 'completion_tokens': 600}
+    for result in results:
+        store.add(StoredPaper(result), result.summary, "export/{}.md".format(result.title), stats)
+    store.flush()
+
+
+def bench_store(args):
+    server = start_completion_server(latency=args.latency / 4)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        papers = []
+        for index in range(2):
+            path = os.path.join(tmp_dir, "paper-{}.pdf".format(index))
+            make_synthetic_pdf(path, num_pages=args.pages // 4, seed=index)
+            paper = summarize.Paper(path=path, title="paper-{}".format(index),
+                                    url="http://arxiv.org/abs/0000.{:05d}v1".format(index), authors=["A. Author"])
+            paper.parse_pdf()
+            papers.append(paper)
+        # a second run of the same entries, e.g. an overlapping query, reads the store instead of the chat model
+        calls = []
+        for options in ((), (), ("--refresh",)):
+            reader = make_reader(tmp_dir, server, *options)
+            server.calls = 0
+            for paper_index, paper in enumerate(papers):
+                reader.summarize_paper(paper_index, paper)
+            reader.store.close()
+            calls.append(server.calls)
+        assert calls == [6, 0, 6], calls
+        report("store", "chat_calls", sum(calls), "calls", runs=len(calls))
+        print("store: chat calls of a first run, a rerun and a --refresh rerun of 2 papers {}".format(calls))
+
+        results = make_abstracts(10000)
+        for batch_size in (1, 20):
+            store = summarize.SummaryStore(os.path.join(tmp_dir, "batch-{}.sqlite".format(batch_size)),
+                                           batch_size=batch_size)
+            start_time = time.time()
+            fill_store(store, results[:1000])
+            cost = time.time() - start_time
+            store.close()
+            report("store", "insert_seconds", cost / 1000, "s", batch_size=batch_size)
+            print("store insert with batch_size {}: {:.3f}ms per summary".format(batch_size, cost / 1000 * 1000))
+
+        store = summarize.SummaryStore(os.path.join(tmp_dir, "search.sqlite"))
+        for archive_size in (1000, 10000):
+            fill_store(store, results[len(store.db.execute("SELECT id FROM summaries").fetchall()):archive_size])
+            start_time = time.time()
+            for _ in range(args.repeat * 10):
+                hits = store.search("deep reinforcement learning", limit=10)
+            cost = (time.time() - start_time) / (args.repeat * 10)
+            assert hits and all("reinforcement" in results[int(hit['title'].split()[1])].summary for hit in hits), hits
+            report("store", "search_seconds", cost, "s", stored=archive_size)
+            print("store search over {} summaries: {:.2f}ms, best hit {}".format(archive_size, cost * 1000, hits[0]['title']))
+        assert store.get(results[5].entry_id)['title'] == results[5].title
+        # non-ASCII queries match words with accents and in other scripts
+        result = make_abstracts(1)[0]
+        result.entry_id, result.title = "http://arxiv.org/abs/2222.00001v1", "Lösungen der Schrödinger-Gleichung"
+        result.summary = "Wir lösen Gleichungen mit 深度强化学习 und Übertragung."
+        fill_store(store, [result])
+        for query in ("schrödinger", "LÖSUNGEN übertragung", "深度强化学习"):
+            hits = store.search(query)
+            assert [hit['entry_id'] for hit in hits] == [result.entry_id], (query, hits)
+        store.close()
+    server.shutdown()
+
+
+def bench_corpus(args):
+    budget = summarize.TokenBudget("gpt-3.5-turbo", 4096, TOKENIZER_CACHE_DIR)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path, num_pages, style, images, title_size, title_lines in make_corpus(tmp_dir):
+            labels = dict(paper=os.path.basename(path), pages=num_pages, style=style, images=images, title_size=title_size)
+            paper, paper_cost = timed(lambda: summarize.Paper(path=path), args.repeat)
+            # get_title reads the first line of each text block, so a wrapped title keeps its first line
+            expected_title = "Synthetic {} Paper Of {} Pages Part 1".format(style.title(), num_pages)
+            title, title_cost = timed(paper.get_title, args.repeat)
+            assert title.startswith(expected_title), (title, expected_title)
+            spans, segment_cost = timed(lambda: summarize.Paper.segmenter.segment(paper.doc_text), args.repeat)
+            assert [name for name in STYLED_SECTIONS if name in spans] == STYLED_SECTIONS, (style, list(spans))
+            image_dir = os.path.join(tmp_dir, "images-" + os.path.basename(path))
+            os.makedirs(image_dir)
+            (image_path, ext), image_cost = timed(lambda: paper.get_image_path(image_dir), args.repeat)
+            assert (image_path is not None) == (images > 0), image_path
+
+            def clip():
+                paper.section_tokens = {}
+                return budget.clip('summary', [paper.title, budget.section_tokens(paper, 'Introduction')], 1000)
+            clip_text, clip_cost = timed(clip, args.repeat)
+            assert len(budget.encode(clip_text)) <= 4096 - 1000
+            for metric, cost in (("paper_seconds", paper_cost), ("title_seconds", title_cost),
+                                 ("segment_seconds", segment_cost), ("image_seconds", image_cost),
+                                 ("clip_seconds", clip_cost)):
+                report("corpus", metric, cost, "s", **labels)
+            print("corpus {:<34} Paper {:6.1f} ms, title {:5.2f} ms, segment {:5.2f} ms, image {:6.1f} ms, clip {:5.1f} ms".format(
+                os.path.basename(path), paper_cost * 1000, title_cost * 1000, segment_cost * 1000,
+                image_cost * 1000, clip_cost * 1000))
+
+
+# runs in a fresh interpreter: what a --pdf_path run pays before its first paper is parsed
+STARTUP_SCRIPT = """
+import json, sys, time
+start_time = time.time()
+import summarize
+imported = time.time()
+args = summarize.get_parser().parse_args(["--pdf_path", sys.argv[1], "--no_cache", "--api_key", "fake"])
+try:
+    summarize.Reader(key_word=args.key_word, query=args.query, filter_keys=args.filter_keys, sort=args.sort, args=args)
+    tokenizer = None
+except Exception as e:
+    tokenizer = repr(e)
+reader = time.time()
+summarize.Paper(path=sys.argv[1])
+parsed = time.time()
+print(json.dumps({"import": imported - start_time, "reader": reader - imported, "paper": parsed - reader,
+                  "tokenizer_error": tokenizer, "modules": sorted(name for name in sys.modules if "." not in name)}))
+"""
+
+
+def import_times(stderr):
+    # -X importtime lines: "import time: self | cumulative | name", nesting shown by indentation
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            if cumulative_us.strip().isdigit() and name.startswith("   ") and not name.startswith("    "):
+                times[name.strip()] = int(cumulative_us) / 1e6
+    return times
+
+
+def bench_startup(args):
+    import subprocess
+    import py_compile
+    # with PYTHONDONTWRITEBYTECODE every start would recompile the script, which no installed copy does
+    py_compile.compile(summarize.__file__)
+    python = [sys.executable, "-X", "importtime"]
+    costs = []
+    for _ in range(args.repeat):
+        start_time = time.time()
+        process = subprocess.run(python + [summarize.__file__, "-h"], capture_output=True, text=True, check=True)
+        costs.append(time.time() - start_time)
+    help_cost = min(costs)
+    heavy = sorted(import_times(process.stderr).items(), key=lambda item: -item[1])[:5]
+    report("startup", "help_seconds", help_cost, "s")
+    print("startup: summarize.py -h {:.0f} ms, slowest imports: {}".format(
+        help_cost * 1000, ", ".join("{} {:.0f} ms".format(name, cost * 1000) for name, cost in heavy)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "small.pdf")
+        make_synthetic_pdf(path, num_pages=3)
+        runs = []
+        for _ in range(args.repeat):
+            process = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, path], capture_output=True, text=True,
+                                     check=True, cwd=tmp_dir,
+                                     env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(summarize.__file__))))
+            runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    run = min(runs, key=lambda run: run["import"] + run["reader"] + run["paper"])
+    cold_start = run["import"] + run["reader"] + run["paper"]
+    for phase in ("import", "reader", "paper"):
+        report("startup", phase + "_seconds", run[phase], "s")
+    report("startup", "pdf_path_seconds", cold_start, "s")
+    unused = [name for name in ("arxiv", "openai", "requests", "numpy") if name in run["modules"]
+              # tiktoken imports requests to download an encoding that is not cached yet
+              and not (name == "requests" and run["tokenizer_error"])]
+    print("startup: --pdf_path cold start {:.0f} ms (import {:.0f} ms, Reader {:.0f} ms, first paper {:.0f} ms), budget {:.0f} ms".format(
+        cold_start * 1000, run["import"] * 1000, run["reader"] * 1000, run["paper"] * 1000, args.startup_budget * 1000))
+    if run["tokenizer_error"]:
+        print("startup: tokenizer not available offline ({}), run `python summarize.py --warm_tokenizer` once".format(
+            run["tokenizer_error"][:80]))
+    assert not unused, "imported before any chat call or arXiv search: {}".format(unused)
+    assert cold_start <= args.startup_budget, "cold start over budget"
+
+
+def bench_end_to_end(args):
+    server = start_completion_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = os.path.join(tmp_dir, "corpus")
+        os.makedirs(corpus_dir)
+        corpus = make_corpus(corpus_dir)
+        argv = ["--pdf_path", corpus_dir, "--api_key", "fake", "--no_cache",
+                "--api_base", "http://127.0.0.1:{}".format(server.server_address[1])]
+        # main() exports relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            server.calls = 0
+            start_time = time.time()
+            summarize.main(summarize.get_parser().parse_args(argv))
+            cost = time.time() - start_time
+        finally:
+            os.chdir(cwd)
+        exports = os.listdir(os.path.join(tmp_dir, "export"))
+        assert len(exports) == len(corpus), exports
+        report("end_to_end", "seconds", cost, "s", papers=len(corpus), latency=args.latency)
+        report("end_to_end", "chat_calls", server.calls, "calls", papers=len(corpus))
+        print("end to end main() on {} papers: {:.2f}s, {} chat calls of {:.2f}s latency".format(
+            len(corpus), cost, server.calls, args.latency))
+    server.shutdown()
+
+
+def run_main(tmp_dir, argv, fail_at=None, failure=None):
+    # main() in tmp_dir; the chat call number fail_at raises the exception failure instead of reaching the server
+    chat_completion = summarize.Reader.chat_completion
+    calls = [0]
+
+    def failing_chat_completion(reader, *args, **kwargs):
+        calls[0] += 1
+        if calls[0] == fail_at:
+            raise failure
+        return chat_completion(reader, *args, **kwargs)
+
+    cwd = os.getcwd()
+    os.chdir(tmp_dir)
+    summarize.Reader.chat_completion = failing_chat_completion
+    try:
+        summarize.main(summarize.get_parser().parse_args(argv))
+    finally:
+        summarize.Reader.chat_completion = chat_completion
+        os.chdir(cwd)
+
+
+def bench_resume(args):
+    # an interrupted run resumed with --resume only makes the chat calls the first attempt did not get
+    # to, and a paper failing halfway is finished by the retry pass from the stage it stopped at
+    import openai
+    server = start_completion_server(latency=args.latency / 4)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = os.path.join(tmp_dir, "corpus")
+        os.makedirs(corpus_dir)
+        corpus = make_corpus(corpus_dir)
+        argv = ["--pdf_path", corpus_dir, "--api_key", "fake", "--no_cache", "--no_store",
+                "--api_base", "http://127.0.0.1:{}".format(server.server_address[1])]
+        runs_dir = os.path.join(tmp_dir, "cache", "runs")
+        total = len(corpus) * 3
+
+        server.calls = 0
+        try:
+            run_main(tmp_dir, argv, fail_at=8, failure=KeyboardInterrupt())
+        except KeyboardInterrupt:
+            pass
+        interrupted_calls = server.calls
+        run_id = os.listdir(runs_dir)[0][:-len(".jsonl")]
+        server.calls = 0
+        start_time = time.time()
+        run_main(tmp_dir, argv + ["--resume", run_id])
+        cost = time.time() - start_time
+        assert interrupted_calls + server.calls == total, (interrupted_calls, server.calls)
+        # the finished run has nothing left to resume and removes its journal
+        assert not os.listdir(runs_dir), os.listdir(runs_dir)
+        report("resume", "chat_calls", server.calls, "calls", interrupted_after=interrupted_calls)
+        report("resume", "seconds", cost, "s", papers=len(corpus))
+        print("resume: interrupted after {} chat calls, --resume made the other {} of {} in {:.2f}s".format(
+            interrupted_calls, server.calls, total, cost))
+
+        server.calls = 0
+        stale_path = os.path.join(runs_dir, "20000101-000000-0000.jsonl")
+        with open(stale_path, "w") as file:
+            file.write('{"event": "run", "pdf_path": "gone"}\n')
+        os.utime(stale_path, (time.time() - 30 * 24 * 3600,) * 2)
+        # not retried by tenacity, like a prompt over the context length
+        run_main(tmp_dir, argv, fail_at=5, failure=openai.error.InvalidRequestError("injected", None))
+        # the failed call never reached the server, so no answer is asked for twice
+        assert server.calls == total, server.calls
+        # the stale journal of a run never resumed is pruned, and this finished run keeps none
+        assert not os.listdir(runs_dir), os.listdir(runs_dir)
+        report("resume", "retry_pass_chat_calls", server.calls, "calls", papers=len(corpus))
+        print("resume: with one chat call failing, the retry pass finished its paper; {} of {} chat calls in all".format(
+            server.calls, total))
+
+        # a streamed paper failing halfway is exported again from the start, not appended to its partial file
+        shutil.rmtree(os.path.join(tmp_dir, "export"))
+        run_main(tmp_dir, argv + ["--stream"], fail_at=5, failure=openai.error.InvalidRequestError("injected", None))
+        for name in os.listdir(os.path.join(tmp_dir, "export")):
+            with open(os.path.join(tmp_dir, "export", name), encoding='utf-8') as file:
+                assert file.read().count("## Paper:") == 1, name
+        print("resume: the retry pass rewrote the partial streamed export of its paper")
+    server.shutdown()
+
+
+class QueryResult:
+    # an arxiv.Result of a fake search, downloaded from pdf_url
+    def __init__(self, index, pdf_url):
+        self.entry_id = "http://arxiv.org/abs/1111.{:05d}v1".format(index)
+        self.title = "Query Result {} {}".format(index, os.path.basename(pdf_url))
+        self.pdf_url = pdf_url
+        self.summary = "We study synthetic documents."
+        self.authors = ["Jane Doe"]
+
+
+def call_service(base, method, path, data=None):
+    import urllib.request
+    import urllib.error
+    request = urllib.request.Request(base + path, method=method,
+                                     data=None if data is None else json.dumps(data).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def bench_service(args):
+    # --serve: jobs submitted over HTTP reuse the warm Reader, so their latency is parse + chat time only
+    server = start_completion_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = os.path.join(tmp_dir, "corpus")
+        os.makedirs(corpus_dir)
+        corpus = make_corpus(corpus_dir)
+        fixtures = start_fixture_server(corpus_dir)
+        argv = ["--serve", "--port", "0", "--api_key", "fake", "--no_cache",
+                "--api_base", "http://127.0.0.1:{}".format(server.server_address[1])]
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            start_time = time.time()
+            http_server, service = summarize.start_service(summarize.get_parser().parse_args(argv),
+                                                           job_workers=2, max_jobs=len(corpus) + 1)
+            warm_up = time.time() - start_time
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+            base = "http://127.0.0.1:{}".format(http_server.server_address[1])
+            assert call_service(base, "POST", "/jobs", {})[0] == 400
+            assert call_service(base, "GET", "/jobs/missing")[0] == 404
+            # the first job is streamed, the others polled; the last one is downloaded by url
+            jobs = []
+            for path, *_ in corpus[:-1]:
+                status, body = call_service(base, "POST", "/jobs", {"pdf_path": path})
+                assert status == 202, body
+                jobs.append(json.loads(body)["id"])
+            url = "http://127.0.0.1:{}/{}".format(fixtures.server_address[1], os.path.basename(corpus[-1][0]))
+            status, body = call_service(base, "POST", "/jobs", {"url": url})
+            assert status == 202, body
+            jobs.append(json.loads(body)["id"])
+            status, body = call_service(base, "GET", "/jobs/{}/events".format(jobs[0]))
+            events = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+            assert [event["event"] for event in events] == ["queued", "started", "papers", "paper", "finished"], events
+            assert events[3]["text"].startswith("## Paper:1"), events[3]
+            results = []
+            for job_id in jobs:
+                while True:
+                    result = json.loads(call_service(base, "GET", "/jobs/" + job_id)[1])
+                    if result["status"] in ("done", "failed"):
+                        break
+                    time.sleep(0.05)
+                assert result["status"] == "done" and len(result["papers"]) == 1, result
+                results.append(result)
+            total = time.time() - start_time
+            latencies = [result["finished"] - result["started"] for result in results]
+            assert b"chatpaper_stage_seconds" in call_service(base, "GET", "/metrics")[1]
+
+            # query jobs run their stages on the service's shared pool, and papers failing in them reach the job
+            iter_arxiv = summarize.Reader.iter_arxiv
+            summarize.Reader.iter_arxiv = lambda reader, max_results=30: [QueryResult(
+                index, "http://127.0.0.1:{}/{}".format(fixtures.server_address[1], name))
+                for index, name in enumerate(reader.query.split())]
+            try:
+                query_jobs = {}
+                for query in (os.path.basename(corpus[0][0]), "missing-1.pdf missing-2.pdf"):
+                    query_jobs[query] = json.loads(call_service(base, "POST", "/jobs", {"query": query})[1])["id"]
+                for query, job_id in query_jobs.items():
+                    body = call_service(base, "GET", "/jobs/{}/events".format(job_id))[1]
+                    events = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+                    names = [event["event"] for event in events]
+                    if query.startswith("missing"):
+                        assert names.count("error") == 2 and events[-1]["status"] == "failed", events
+                    else:
+                        assert "paper" in names and events[-1]["status"] == "done", events
+            finally:
+                summarize.Reader.iter_arxiv = iter_arxiv
+            http_server.shutdown()
+            http_server.server_close()
+            service.close()
+        finally:
+            os.chdir(cwd)
+        report("service", "warm_up_seconds", warm_up, "s")
+        report("service", "job_seconds_p50", float(np.median(latencies)), "s", latency=args.latency)
+        report("service", "seconds", total, "s", jobs=len(jobs), latency=args.latency)
+        print("service: warm-up {:.2f}s once, then {} jobs in {:.2f}s, median job {:.2f}s with {:.2f}s chat latency".format(
+            warm_up, len(jobs), total, float(np.median(latencies)), args.latency))
+    fixtures.shutdown()
+    server.shutdown()
+
+
+def git_commit():
+    import subprocess
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def result_key(result):
+    return tuple(sorted((key, str(value)) for key, value in result.items() if key not in ("value", "unit")))
+
+
+def compare(baseline_file):
+    with open(baseline_file, encoding='utf-8') as file:
+        baseline = json.load(file)
+    old = {result_key(result): result for result in baseline["results"]}
+    print("compared with {} ({})".format(baseline_file, baseline.get("commit")))
+    for result in RESULTS:
+        previous = old.get(result_key(result))
+        if previous is None or not previous["value"]:
+            continue
+        labels = ", ".join("{}={}".format(key, value) for key, value in result.items()
+                           if key not in ("case", "metric", "value", "unit"))
+        print("{:<12}{:<22}{:>12.4g}{:>12.4g}{:>8.2f}x  {} {}".format(
+            result["case"], result["metric"], previous["value"], result["value"],
+            result["value"] / previous["value"], result["unit"], labels))
+
+
+def read_summary_sections(paper):
+    # the sections summarize_paper looks at
+    keys = list(paper.section_text_dict.keys())
+    texts = [paper.section_text_dict[keys[0]], paper.section_text_dict['paper_info']]
+    for key in keys:
+        if 'method' in key.lower() or 'conclu' in key.lower():
+            texts.append(paper.section_text_dict[key])
+    return texts
+
+
+def bench_lazy(args):
+    import tracemalloc
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        num_pages = max(args.pages, 120)
+        titles = []
+        for variant, lazy, outline in (("eager", False, True), ("lazy", True, True), ("lazy_no_outline", True, False)):
+            path = os.path.join(tmp_dir, "thesis-{}.pdf".format(variant))
+            make_synthetic_pdf(path, num_pages=num_pages, reference_pages=num_pages // 3, outline=outline)
+            tracemalloc.start()
+            start_time = time.time()
+            with summarize.Paper(path=path, lazy=lazy) as paper:
+                read_summary_sections(paper)
+                touched = len(paper.page_texts) if lazy else num_pages
+            cost = time.time() - start_time
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            titles.append(paper.title)
+            unread = [name for name in paper.section_page_dict
+                      if lazy and outline and name not in paper.section_text_dict.texts]
+            if unread:
+                # sections that were not read before close() can't be read any more
+                try:
+                    paper.section_text_dict[unread[-1]]
+                    raise AssertionError("read {} of a closed paper".format(unread[-1]))
+                except ValueError:
+                    pass
+            if not outline:
+                # without an outline pages are scanned up to the references, and no summary section is lost
+                assert touched < num_pages, touched
+                assert any('conclu' in name.lower() for name in paper.section_text_dict.texts), paper.section_page_dict
+            report("lazy", "seconds", cost, "s", variant=variant)
+            report("lazy", "pages_read", touched, "pages", variant=variant)
+            print("{} paper: {:.2f}s, {} of {} pages read, peak {:.1f} MB".format(
+                variant, cost, touched, num_pages, peak / 1e6))
+        assert len(set(titles)) == 1, titles
+
+
+class SleepReader:
+    journal = None
+
+    def get_pdf_dir(self):
+        return ''
+
+
+class SleepPipeline(summarize.Pipeline):
+    # stage costs are replaced by fixed sleeps so only the scheduling is measured
+    def __init__(self, costs, **kwargs):
+        summarize.Pipeline.__init__(self, SleepReader(), **kwargs)
+        self.costs = costs
+
+    def download(self, item):
+        time.sleep(self.costs[0])
+        return item
+
+    def parse(self, item):
+        time.sleep(self.costs[1])
+        return item
+
+    def summarize(self, item):
+        time.sleep(self.costs[2])
+        return item
+
+
+def bench_pipeline(args):
+    costs = (0.02, 0.01, 0.03)
+    items = list(range(args.papers))
+    start_time = time.time()
+    done = SleepPipeline(costs, download_workers=1, parse_workers=1, summary_workers=1).run(items)
+    cost = time.time() - start_time
+    assert done == items
+    report("pipeline", "seconds", cost, "s", papers=args.papers)
+    print("pipeline {} papers: {:.2f}s (serial {:.2f}s, slowest stage {:.2f}s)".format(
+        args.papers, cost, sum(costs) * args.papers, max(costs) * args.papers))
+
+
+# the cases that build a Reader or a TokenBudget need the tokenizer, from the network or from the
+# directory `python summarize.py --warm_tokenizer` filled
+TOKENIZER_CASES = {"tokenize", "map_reduce", "keys", "summary_modes", "stream", "dedup", "store", "corpus",
+                   "end_to_end", "service", "resume"}
+TOKENIZER_CACHE_DIR = os.path.join('./', 'cache', 'tiktoken')
+
+CASES = {
+    "extraction": bench_extraction,
+    "segmentation": bench_segmentation,
+    "download": bench_download,
+    "pipeline": bench_pipeline,
+    "parse": bench_parse,
+    "filter": bench_filter,
+    "rank": bench_rank,
+    "tokenize": bench_tokenize,
+    "map_reduce": bench_map_reduce,
+    "keys": bench_keys,
+    "summary_modes": bench_summary_modes,
+    "stream": bench_stream,
+    "image": bench_image,
+    "lazy": bench_lazy,
+    "dedup": bench_dedup,
+    "store": bench_store,
+    "corpus": bench_corpus,
+    "end_to_end": bench_end_to_end,
+    "service": bench_service,
+    "resume": bench_resume,
+    "startup": bench_startup,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=60, help="pages in the synthetic paper")
+    parser.add_argument("--repeat", type=int, default=3, help="how many times each case is run")
+    parser.add_argument("--papers", type=int, default=20, help="papers in batch cases")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds of latency added by the local fixture servers")
+    parser.add_argument("--download_workers", type=int, default=8, help="workers for the pooled download case")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes for the parallel parse case")
+    parser.add_argument("--chunk_workers", type=int, default=4, help="chunk workers for the map_reduce case")
+    parser.add_argument("--max_calls", type=int, default=12, help="chat calls allowed per paper in the map_reduce case")
+    parser.add_argument("--log_level", type=str, default='WARNING', help="log level of summarize.py while the cases run")
+    parser.add_argument("--startup_budget", type=float, default=0.5, help="seconds a --pdf_path run may take to parse its first page")
+    parser.add_argument("--output", type=str, default='', help="write every measurement to this JSON file")
+    parser.add_argument("--baseline", type=str, default='', help="JSON file of an earlier run (--output) to compare with")
+    parser.add_argument("--case", type=str, default='all', help="one of: all, " + ", ".join(CASES))
+    parser.add_argument("--tiktoken_cache_dir", type=str, default=TOKENIZER_CACHE_DIR, help="tokenizer cache filled by `python summarize.py --warm_tokenizer`")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s')
+    TOKENIZER_CACHE_DIR = os.path.abspath(args.tiktoken_cache_dir)
+    # main(), the service and the startup subprocess read it from the environment
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', TOKENIZER_CACHE_DIR)
+    try:
+        summarize.load_encoding("gpt-3.5-turbo", TOKENIZER_CACHE_DIR)
+        tokenizer_error = None
+    except Exception as e:
+        tokenizer_error = e
+        print("tokenizer not available offline ({}), run `python summarize.py --warm_tokenizer` once".format(
+            str(e)[:80]))
+    for name, case in CASES.items():
+        if args.case not in ('all', name):
+            continue
+        if name in TOKENIZER_CASES and tokenizer_error is not None:
+            print("{}: skipped, no tokenizer".format(name))
+            continue
+        case(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({"commit": git_commit(), "time": time.time(), "python": sys.version.split()[0],
+                       "args": vars(args), "results": RESULTS}, file, indent=1)
+    if args.baseline:
+        compare(args.baseline)
@@ -1,112 +1,594 @@
 import time
-import numpy as np
 import os
 import re
 import datetime
-import arxiv
-import openai, tenacity
-import base64, requests
+import tenacity
+import base64
 import argparse
 import configparser
 import json
-import tiktoken
-import fitz, io, os
-from PIL import Image
+import io
+import bisect
+import collections.abc
+import sys
+import threading
+import queue
+import sqlite3
+import hashlib
+import gzip
+import zlib
+import logging
+import contextlib
+import itertools
+import functools
+import copy
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse
+# numpy, arxiv, openai, requests, tiktoken, fitz and PIL take most of the start-up time, so
+# they are imported by the code that uses them: `-h` or a --pdf_path run only pays for its own
 
 
-def download_pdf(url, file_name):
-    response = requests.get(url)
-    with open(file_name, 'wb') as file:
-        file.write(response.content)
-    print(f"PDF downloaded from {url} and saved as {file_name}")
+logger = logging.getLogger("summarize")
+
+
+class Tracer:
+    # spans of the run's stages (search, download, parse, tokenize, llm, export, summary). Spans
+    # nest per thread and inherit the paper of their parent; finished spans are kept for the
+    # end-of-run table and, with --trace_file, appended to a JSONL file as they finish
+    def __init__(self):
+        self.run_id = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.spans = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.trace_file = None
+
+    def open(self, trace_file):
+        if trace_file:
+            os.makedirs(os.path.dirname(trace_file) or '.', exist_ok=True)
+            self.trace_file = open(trace_file, 'a', encoding='utf-8')
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+            self.local.retries = {}
+        return self.local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else {}
+
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        stack = self._stack()
+        parent = self.current()
+        span = {'run': self.run_id, 'id': next(self.ids), 'parent': parent.get('id'), 'stage': stage,
+                'paper': parent.get('paper'), 'start': time.time(),
+                'retries': self.local.retries.pop(stage, 0)}
+        span.update(fields)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span['error'] = repr(e)
+            raise
+        finally:
+            stack.pop()
+            span['seconds'] = time.time() - span['start']
+            if stage is not None:
+                self.record(span)
+
+    def paper(self, paper):
+        # labels the spans opened inside it without being a span itself
+        return self.span(None, paper=paper)
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(span, ensure_ascii=False, default=str) + '\n')
+                # nothing stays buffered, so a forked worker has no copy of it to write out again
+                self.trace_file.flush()
+
+    def adopt(self, spans):
+        # spans finished by another process: give them ids of this run before recording them
+        ids = {span['id']: next(self.ids) for span in spans}
+        for span in spans:
+            span.update(run=self.run_id, id=ids[span['id']], parent=ids.get(span['parent']))
+            self.record(span)
+
+    def retry_hook(self, stage):
+        # tenacity before_sleep callback: the next span of this stage on the thread is a retry
+        def before_sleep(retry_state):
+            self._stack()
+            self.local.retries[stage] = self.local.retries.get(stage, 0) + 1
+            logger.warning("%s retry %d after %r", stage, retry_state.attempt_number,
+                           retry_state.outcome.exception())
+        return before_sleep
+
+    def traced(self, stage):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, stage, iterable, **fields):
+        # time spent waiting for the next item of a lazy iterable, e.g. arXiv result paging
+        iterator = iter(iterable)
+        while True:
+            with self.span(stage, **fields) as span:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    span['done'] = True
+                    return
+            yield item
+
+    def stage_stats(self):
+        import numpy as np
+        stages = {}
+        with self.lock:
+            for span in self.spans:
+                stages.setdefault(span['stage'], []).append(span)
+        rows = []
+        for stage, spans in sorted(stages.items()):
+            seconds = np.array([span['seconds'] for span in spans])
+            rows.append({'stage': stage, 'count': len(spans),
+                         'errors': sum(1 for span in spans if 'error' in span),
+                         'p50': float(np.percentile(seconds, 50)), 'p95': float(np.percentile(seconds, 95)),
+                         'total': float(seconds.sum()),
+                         'retries': sum(span.get('retries', 0) for span in spans),
+                         'bytes': sum(span.get('bytes', 0) for span in spans),
+                         'pages': sum(span.get('pages', 0) for span in spans),
+                         'prompt_tokens': sum(span.get('prompt_tokens', 0) for span in spans),
+                         'completion_tokens': sum(span.get('completion_tokens', 0) for span in spans)})
+        return rows
+
+    def show_table(self):
+        rows = self.stage_stats()
+        if not rows:
+            return
+        logger.info("{:<20}{:>7}{:>7}{:>9}{:>9}{:>10}{:>8}{:>12}{:>8}{:>10}{:>12}".format(
+            "stage", "count", "errors", "p50", "p95", "total", "retries", "bytes", "pages", "prompt", "completion"))
+        for row in rows:
+            logger.info("{:<20}{:>7}{:>7}{:>9.3f}{:>9.3f}{:>10.2f}{:>8}{:>12}{:>8}{:>10}{:>12}".format(
+                row['stage'], row['count'], row['errors'], row['p50'], row['p95'], row['total'], row['retries'],
+                row['bytes'], row['pages'], row['prompt_tokens'], row['completion_tokens']))
+
+    def prometheus_text(self):
+        lines = ["# HELP chatpaper_stage_seconds Wall time of the spans of one stage in the last run.",
+                 "# TYPE chatpaper_stage_seconds summary"]
+        rows = self.stage_stats()
+        for row in rows:
+            for quantile, label in (('p50', '0.5'), ('p95', '0.95')):
+                lines.append('chatpaper_stage_seconds{{stage="{}",quantile="{}"}} {}'.format(
+                    row['stage'], label, row[quantile]))
+            lines.append('chatpaper_stage_seconds_sum{{stage="{}"}} {}'.format(row['stage'], row['total']))
+            lines.append('chatpaper_stage_seconds_count{{stage="{}"}} {}'.format(row['stage'], row['count']))
+        for name in ('errors', 'retries', 'bytes', 'pages', 'prompt_tokens', 'completion_tokens'):
+            lines.append("# TYPE chatpaper_stage_{}_total counter".format(name))
+            for row in rows:
+                lines.append('chatpaper_stage_{}_total{{stage="{}"}} {}'.format(name, row['stage'], row[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # node_exporter textfile format; written to a temporary file first so a scrape never sees half of it
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+
+    def trim(self, keep):
+        # a long-running --serve process keeps only the latest spans for its /metrics
+        with self.lock:
+            del self.spans[:-keep]
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+tracer = Tracer()
+
+
+def retry_download_error(exception):
+    # a missing or forbidden file stays that way, so of the 4xx answers only a timeout (408) or
+    # a rate limit (429) is tried again; Ctrl-C stops the download rather than wait for a retry
+    import requests
+    if isinstance(exception, requests.HTTPError) and exception.response is not None:
+        status = exception.response.status_code
+        return not 400 <= status < 500 or status in (408, 429)
+    return isinstance(exception, Exception)
+
+
+class PdfDownloader:
+    # shared connection pool + bounded worker pool; files are streamed to a .part file
+    # and a retry resumes from where the last attempt stopped with an HTTP Range request
+    def __init__(self, max_workers=8, per_host=4, chunk_size=1 << 16, timeout=60):
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.per_host = per_host
+        self.max_workers = max_workers
+        self.session = None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.host_slots = {}
+        self.lock = threading.Lock()
+
+    def _get_session(self):
+        # built on the first download, so runs that download nothing never import requests
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                self.session.mount('http://', adapter)
+                self.session.mount('https://', adapter)
+            return self.session
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_slots[host]
+
+    @tenacity.retry(wait=tenacity.wait_exponential(multiplier=0.5, min=0.5, max=10),
+                    stop=tenacity.stop_after_attempt(5),
+                    retry=tenacity.retry_if_exception(retry_download_error),
+                    before_sleep=tracer.retry_hook('download'),
+                    reraise=True)
+    def fetch(self, url, file_name):
+        part_name = file_name + '.part'
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with tracer.span('download', url=url, resumed_at=offset) as span, self._host_slot(url):
+            with self._get_session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if offset and response.status_code == 416:
+                    # the previous attempt already got every byte
+                    os.replace(part_name, file_name)
+                    return file_name
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                span['bytes'] = 0
+                with open(part_name, 'ab' if offset else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        file.write(chunk)
+                        span['bytes'] += len(chunk)
+        os.replace(part_name, file_name)
+        return file_name
+
+    def submit(self, url, file_name):
+        return self.executor.submit(self.fetch, url, file_name)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.session is not None:
+            self.session.close()
+
+
+def download_pdf(url, file_name, downloader=None):
+    if downloader is None:
+        downloader = PdfDownloader(max_workers=1, per_host=1)
+        downloader.fetch(url, file_name)
+        downloader.close()
+    else:
+        downloader.fetch(url, file_name)
+    logger.info("PDF downloaded from %s and saved as %s", url, file_name)
+
+
+class PageRecord:
+    # everything the parser needs from one page, taken from a single TextPage
+    def __init__(self, index, text, spans):
+        self.index = index
+        self.text = text    # same as page.get_text()
+        self.spans = spans  # (size, flags, text) of the first span of each text block
+
+
+@tracer.traced('parse.pages')
+def extract_pages(doc, page_numbers=None):
+    pages = []
+    if page_numbers is None:
+        page_numbers = range(len(doc))
+    for page_index in page_numbers:
+        page = doc[page_index]
+        textpage = page.get_textpage()
+        text = textpage.extractText()
+        spans = []
+        for block in textpage.extractDICT()["blocks"]:
+            if block["type"] != 0 or not len(block["lines"]):
+                continue
+            if len(block["lines"][0]["spans"]):
+                first_span = block["lines"][0]["spans"][0]
+                spans.append((first_span["size"], first_span["flags"], first_span["text"]))
+        pages.append(PageRecord(page_index, text, spans))
+    tracer.current().update(pages=len(pages), bytes=sum(len(page.text) for page in pages))
+    return pages
+
+
+SECTION_LIST = ["Abstract", 
+        'Introduction', 'Related Work', 'Background', 
+        "Preliminary", "Problem Formulation",
+        'Methods', 'Methodology', "Method", 'Approach', 'Approaches',
+        "Materials and Methods", "Experiment Settings",
+        'Experiment',  "Experimental Results", "Evaluation", "Experiments",                        
+        "Results", 'Findings', 'Data Analysis',                                                                        
+        "Discussion", "Results and Discussion", "Conclusion",
+        'References']
+ROMAN_NUM = ["I", "II", 'III', "IV", "V", "VI", "VII", "VIII", "IIX", "IX", "X"]
+DIGIT_NUM = [str(d+1) for d in range(10)]
+
+
+class SectionSegmenter:
+    # all heading variants are compiled into one regex, so a document is scanned once
+    def __init__(self, section_list=SECTION_LIST, prefixes=ROMAN_NUM + DIGIT_NUM):
+        self.variants = {}
+        for section_name in section_list:
+            for variant in (section_name, section_name.upper(), section_name.capitalize()):
+                self.variants.setdefault(variant, section_name)
+        names = sorted((v for v in self.variants if self.variants[v] != "Abstract"), key=len, reverse=True)
+        abstracts = [v for v in self.variants if self.variants[v] == "Abstract"]
+        prefix = r'(?:(?:' + '|'.join(sorted(prefixes, key=len, reverse=True)) + r')\.?[ \t]+)?'
+        self.pattern = re.compile(
+            r'^[ \t]*(?P<abstract>' + '|'.join(abstracts) + r')\b'
+            r'|^[ \t]*' + prefix + r'(?P<name>' + '|'.join(map(re.escape, names)) + r')[ \t]*$',
+            re.M)
+
+    def segment(self, text):
+        # returns {section_name: (start, end)} in document order; a section runs from its
+        # heading to the line where the next heading starts
+        starts = []
+        seen = set()
+        for match in self.pattern.finditer(text):
+            group = 'abstract' if match.group('abstract') else 'name'
+            section_name = self.variants[match.group(group)]
+            if section_name in seen:
+                continue
+            seen.add(section_name)
+            starts.append((section_name, match.start(group), match.start()))
+        spans = {}
+        for index, (section_name, start, _) in enumerate(starts):
+            end = starts[index + 1][2] if index + 1 < len(starts) else len(text)
+            spans[section_name] = (start, end)
+        return spans
+
+
+# bump whenever a change to Paper parsing changes what it produces; cached parses
+# from older versions are then ignored
+PARSER_VERSION = 4
+
+# the title is looked for on the first pages only, in eager and lazy mode alike
+TITLE_PAGES = 2
+
+
+class LazySections(collections.abc.Mapping):
+    # section name -> text for a lazy Paper. A section's pages are read and cut the first
+    # time the section is looked up, so untouched sections cost nothing
+    def __init__(self, paper):
+        self.paper = paper
+        self.texts = {}
+        names = list(paper.section_page_dict)
+        self.names = names[1:] if paper.abs and names else names
+        self.names += ['title', 'paper_info']
+
+    def __getitem__(self, section_name):
+        if section_name not in self.names:
+            raise KeyError(section_name)
+        if section_name not in self.texts:
+            self.texts[section_name] = self.paper._get_lazy_section(section_name)
+        return self.texts[section_name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
 
 
 class Paper:
-    def __init__(self, path, title='', url='', abs='', authors=[]):       
+    segmenter = SectionSegmenter()
+
+
+    def __init__(self, path, title='', url='', abs='', authors=[], lazy=False, parse=True):       
+        import fitz
         self.url =  url          
         self.path = path         
         self.section_names = []  
         self.section_texts = {}      
         self.abs = abs
         self.title_page = 0
-        if title == '':
+        self.pages = None
+        self.roman_num = ROMAN_NUM
+        self.digit_num = DIGIT_NUM
+        self.pdf = None
+        self.page_texts = {}
+        # parse=False leaves the rest to the caller, e.g. from_dict, whose stored title may be '' too
+        if parse and title == '' and lazy:
+            # only the first pages are read up front; use the paper as a context manager
+            # so the document stays open while sections are being read
+            self.pdf = fitz.open(self.path)
+            self.pages = extract_pages(self.pdf, range(min(TITLE_PAGES, len(self.pdf))))
+            self.title = self.get_title()
+            self.section_page_dict = self._get_lazy_page_index()
+            logger.debug("section_page_dict %s", self.section_page_dict)
+            self.section_text_dict = LazySections(self)
+        elif parse and title == '':
             self.pdf = fitz.open(self.path) 
+            self.pages = extract_pages(self.pdf)
             self.title = self.get_title()
             self.parse_pdf()            
         else:
             self.title = title
         self.authors = authors        
-        self.roman_num = ["I", "II", 'III', "IV", "V", "VI", "VII", "VIII", "IIX", "IX", "X"]
-        self.digit_num = [str(d+1) for d in range(10)]
         self.first_image = ''
+        self.largest_image = None
+        self.section_tokens = {}
         
+    def to_dict(self):
+        return {'title': self.title,
+                'title_page': self.title_page,
+                'section_page_dict': self.section_page_dict,
+                'section_text_dict': self.section_text_dict,
+                'largest_image': self.largest_image}
+
+    @classmethod
+    def from_dict(cls, path, data):
+        paper = cls(path=path, title=data['title'], parse=False)
+        paper.title_page = data['title_page']
+        paper.section_page_dict = data['section_page_dict']
+        paper.section_text_dict = data['section_text_dict']
+        paper.largest_image = data['largest_image']
+        return paper
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pdf is not None and not self.pdf.is_closed:
+            self.pdf.close()
+        self.pdf = None
+
+    def page_text(self, page_index):
+        if page_index not in self.page_texts:
+            if self.pdf is None:
+                raise ValueError("{} is closed; read the sections of a lazy Paper before close()".format(self.path))
+            self.page_texts[page_index] = self.pdf[page_index].get_text()
+        return self.page_texts[page_index]
+
+    @tracer.traced('parse.section_index')
+    def _get_lazy_page_index(self):
+        # arXiv PDFs usually carry a bookmark outline, which gives section pages without
+        # reading any page text. Without one, pages are scanned in order until the section after
+        # the conclusion starts, so references and appendices are still never read
+        section_page_dict = {}
+        self.index_pages = len(self.pdf)
+        for level, toc_title, page_number in self.pdf.get_toc(simple=True):
+            match = self.segmenter.pattern.match(toc_title.strip())
+            if match and page_number > 0:
+                section_name = self.segmenter.variants[match.group('abstract') or match.group('name')]
+                section_page_dict.setdefault(section_name, page_number - 1)
+        if not section_page_dict:
+            for page in self.pages:
+                self.page_texts.setdefault(page.index, page.text)
+            for page_index in range(len(self.pdf)):
+                for section_name in self.segmenter.segment(self.page_text(page_index)):
+                    section_page_dict.setdefault(section_name, page_index)
+                names = list(section_page_dict)
+                conclusion = [index for index, name in enumerate(names) if 'conclu' in name.lower()]
+                if conclusion and conclusion[0] + 1 < len(names):
+                    self.index_pages = page_index + 1
+                    break
+            logger.debug("%s has no outline, %d of %d pages scanned for headings",
+                         self.path, self.index_pages, len(self.pdf))
+        elif "Abstract" not in section_page_dict:
+            # outlines rarely list the abstract; look for it on the pages read for the title
+            for page in self.pages:
+                if "Abstract" in self.segmenter.segment(page.text):
+                    # put first, so it stays ahead of sections starting on the same page
+                    section_page_dict = dict([("Abstract", page.index)] + list(section_page_dict.items()))
+                    break
+        return dict(sorted(section_page_dict.items(), key=lambda item: item[1]))
+
+    @tracer.traced('parse.section_text')
+    def _get_lazy_section(self, section_name):
+        if section_name == 'title':
+            return self.title
+        if section_name == 'paper_info':
+            return self.get_paper_info()
+        names = list(self.section_page_dict)
+        start_page = self.section_page_dict[section_name]
+        index = names.index(section_name)
+        # read up to and including the page where the next section starts
+        end_page = self.section_page_dict[names[index + 1]] if index + 1 < len(names) else self.index_pages - 1
+        text = ''.join(self.page_text(page_index) for page_index in range(start_page, max(start_page, end_page) + 1))
+        start, end = self.segmenter.segment(text).get(section_name, (0, len(text)))
+        return text[start:end].replace('-\n', '').replace('\n', ' ')
+
+    def load_pages(self):
+        # one extraction pass per paper, shared by every parsing step below
+        if self.pages is None:
+            import fitz
+            with fitz.open(self.path) as doc:
+                self.pages = extract_pages(doc)
+        return self.pages
+
     def parse_pdf(self):
-        self.pdf = fitz.open(self.path) 
-        self.text_list = [page.get_text() for page in self.pdf]
-        self.all_text = ' '.join(self.text_list)
+        self.load_pages()
         self.section_page_dict = self._get_all_page_index()
-        print("section_page_dict", self.section_page_dict)
+        logger.debug("section_page_dict %s", self.section_page_dict)
         self.section_text_dict = self._get_all_page() 
         self.section_text_dict.update({"title": self.title})
         self.section_text_dict.update({"paper_info": self.get_paper_info()})
-        self.pdf.close()    
+        if getattr(self, 'pdf', None) is not None:
+            self.pdf.close()    
 
     def get_paper_info(self):
-        first_page_text = self.pdf[self.title_page].get_text()
+        first_page_text = self.load_pages()[self.title_page].text
         if "Abstract" in self.section_text_dict.keys():
             abstract_text = self.section_text_dict['Abstract']
         else:
             abstract_text = self.abs
-        introduction_text = self.section_text_dict['Introduction']
+        introduction_text = self.section_text_dict.get('Introduction', '')
         first_page_text = first_page_text.replace(abstract_text, "").replace(introduction_text, "")
         return first_page_text
         
-    def get_image_path(self, image_path=''):
-        # open file
+    def find_largest_image(self, pdf):
+        # xref, page and size of the largest image, {} when there is none
+        largest_image = {}
+        seen = set()
         max_size = 0
-        image_list = []
+        for page_number in range(len(pdf)):
+            for image in pdf[page_number].get_images():
+                xref_value, width, height = image[0], image[2], image[3]
+                if xref_value in seen:
+                    continue
+                seen.add(xref_value)
+                if width * height > max_size:
+                    max_size = width * height
+                    largest_image = {'xref': xref_value, 'page': page_number, 'width': width, 'height': height}
+        return largest_image
+
+    def get_image_path(self, image_path=''):
+        # the largest image is picked from the xref table (width/height of get_images()),
+        # so only the winner is ever decoded
+        import fitz
+        from PIL import Image
         with fitz.Document(self.path) as my_pdf_file:
-            for page_number in range(1, len(my_pdf_file) + 1):
-                page = my_pdf_file[page_number - 1]
-                images = page.get_images()                
-                for image_number, image in enumerate(page.get_images(), start=1):           
-                    xref_value = image[0]
-                    base_image = my_pdf_file.extract_image(xref_value)
-                    image_bytes = base_image["image"]
-                    ext = base_image["ext"]
-                    image = Image.open(io.BytesIO(image_bytes))
-                    image_size = image.size[0] * image.size[1]
-                    if image_size > max_size:
-                        max_size = image_size
-                    image_list.append(image)
-        for image in image_list:                            
-            image_size = image.size[0] * image.size[1]
-            if image_size == max_size:                
-                image_name = f"image.{ext}"
-                im_path = os.path.join(image_path, image_name)
-                print("im_path:", im_path)
-                
-                max_pix = 480
-                origin_min_pix = min(image.size[0], image.size[1])
-                
-                if image.size[0] > image.size[1]:
-                    min_pix = int(image.size[1] * (max_pix/image.size[0]))
-                    newsize = (max_pix, min_pix)
-                else:
-                    min_pix = int(image.size[0] * (max_pix/image.size[1]))
-                    newsize = (min_pix, max_pix)
-                image = image.resize(newsize)
-                
-                image.save(open(im_path, "wb"))
-                return im_path, ext
-        return None, None
+            if self.largest_image is None:
+                self.largest_image = self.find_largest_image(my_pdf_file)
+            if not self.largest_image:
+                return None, None
+            base_image = my_pdf_file.extract_image(self.largest_image['xref'])
+        ext = base_image["ext"]
+        image_name = f"image.{ext}"
+        im_path = os.path.join(image_path, image_name)
+        logger.debug("im_path: %s", im_path)
+
+        max_pix = 480
+        image = Image.open(io.BytesIO(base_image["image"]))
+        if image.size[0] > image.size[1]:
+            min_pix = int(image.size[1] * (max_pix/image.size[0]))
+            newsize = (max_pix, min_pix)
+        else:
+            min_pix = int(image.size[0] * (max_pix/image.size[1]))
+            newsize = (min_pix, max_pix)
+        # JPEGs are decoded straight at a reduced scale close to the target size
+        image.draft(image.mode, newsize)
+        image = image.resize(newsize)
+        
+        image.save(open(im_path, "wb"))
+        return im_path, ext
     
     def get_chapter_names(self,):
-        doc = fitz.open(self.path) 
-        text_list = [page.get_text() for page in doc]
-        all_text = ''
-        for text in text_list:
-            all_text += text
+        all_text = ''.join(page.text for page in self.load_pages())
         chapter_names = []
         for line in all_text.split('\n'):
             line_list = line.split(' ')
@@ -115,180 +597,1065 @@ class Paper:
                 space_split_list = line.split(' ')
                 if 1 < len(space_split_list) < 5:
                     if 1 < len(point_split_list) < 5 and (point_split_list[0] in self.roman_num or point_split_list[0] in self.digit_num):
-                        print("line:", line)
+                        logger.debug("line: %s", line)
                         chapter_names.append(line)        
         
         return chapter_names
         
+    @tracer.traced('parse.title')
     def get_title(self):
-        doc = self.pdf
+        pages = self.load_pages()[:TITLE_PAGES]
         max_font_size = 0 
         max_string = "" 
         max_font_sizes = [0]
-        for page_index, page in enumerate(doc): 
-            text = page.get_text("dict") 
-            blocks = text["blocks"] 
-            for block in blocks: 
-                if block["type"] == 0 and len(block['lines']):
-                    if len(block["lines"][0]["spans"]):
-                        font_size = block["lines"][0]["spans"][0]["size"]
-                        max_font_sizes.append(font_size)
-                        if font_size > max_font_size:
-                            max_font_size = font_size
-                            max_string = block["lines"][0]["spans"][0]["text"] 
+        for page in pages: 
+            for font_size, font_flags, cur_string in page.spans:
+                max_font_sizes.append(font_size)
+                if font_size > max_font_size:
+                    max_font_size = font_size
+                    max_string = cur_string 
         max_font_sizes.sort()                
-        print("max_font_sizes", max_font_sizes[-10:])
+        logger.debug("max_font_sizes %s", max_font_sizes[-10:])
         cur_title = ''
-        for page_index, page in enumerate(doc):
-            text = page.get_text("dict")
-            blocks = text["blocks"]
-            for block in blocks:
-                if block["type"] == 0 and len(block['lines']):
-                    if len(block["lines"][0]["spans"]):
-                        cur_string = block["lines"][0]["spans"][0]["text"] 
-                        font_flags = block["lines"][0]["spans"][0]["flags"]
-                        font_size = block["lines"][0]["spans"][0]["size"]                     
-                        if abs(font_size - max_font_sizes[-1]) < 0.3 or abs(font_size - max_font_sizes[-2]) < 0.3:                        
-                            if len(cur_string) > 4 and "arXiv" not in cur_string:                            
-                                if cur_title == ''    :
-                                    cur_title += cur_string                       
-                                else:
-                                    cur_title += ' ' + cur_string                       
-                            self.title_page = page_index
+        for page in pages:
+            for font_size, font_flags, cur_string in page.spans:
+                if abs(font_size - max_font_sizes[-1]) < 0.3 or abs(font_size - max_font_sizes[-2]) < 0.3:                        
+                    if len(cur_string) > 4 and "arXiv" not in cur_string:                            
+                        if cur_title == ''    :
+                            cur_title += cur_string                       
+                        else:
+                            cur_title += ' ' + cur_string                       
+                    self.title_page = page.index
         title = cur_title.replace('\n', ' ')                        
         return title
 
 
+    @tracer.traced('parse.section_index')
     def _get_all_page_index(self):
-        section_list = ["Abstract", 
-                'Introduction', 'Related Work', 'Background', 
-                "Preliminary", "Problem Formulation",
-                'Methods', 'Methodology', "Method", 'Approach', 'Approaches',
-                "Materials and Methods", "Experiment Settings",
-                'Experiment',  "Experimental Results", "Evaluation", "Experiments",                        
-                "Results", 'Findings', 'Data Analysis',                                                                        
-                "Discussion", "Results and Discussion", "Conclusion",
-                'References']
+        text_list = [page.text for page in self.load_pages()]
+        self.page_starts = []
+        offset = 0
+        for text in text_list:
+            self.page_starts.append(offset)
+            offset += len(text)
+        self.doc_text = ''.join(text_list)
+        self.section_spans = self.segmenter.segment(self.doc_text)
         section_page_dict = {}
-        for page_index, page in enumerate(self.pdf):
-            cur_text = page.get_text()
-            for section_name in section_list:
-                section_name_upper = section_name.upper()
-                if "Abstract" == section_name and section_name in cur_text:
-                    section_page_dict[section_name] = page_index
-                else:
-                    if section_name + '\n' in cur_text:
-                        section_page_dict[section_name] = page_index
-                    elif section_name_upper + '\n' in cur_text:
-                        section_page_dict[section_name] = page_index
+        for section_name, (start, end) in self.section_spans.items():
+            section_page_dict[section_name] = bisect.bisect_right(self.page_starts, start) - 1
         return section_page_dict
 
+    @tracer.traced('parse.section_text')
     def _get_all_page(self):
-        text = ''
-        text_list = []
         section_dict = {}
-        
-        text_list = [page.get_text() for page in self.pdf]
-        for sec_index, sec_name in enumerate(self.section_page_dict):
-            print(sec_index, sec_name, self.section_page_dict[sec_name])
+        for sec_index, (sec_name, (start, end)) in enumerate(self.section_spans.items()):
+            logger.debug("%s %s %s", sec_index, sec_name, self.section_page_dict[sec_name])
             if sec_index <= 0 and self.abs:
                 continue
-            else:
-                start_page = self.section_page_dict[sec_name]
-                if sec_index < len(list(self.section_page_dict.keys()))-1:
-                    end_page = self.section_page_dict[list(self.section_page_dict.keys())[sec_index+1]]
-                else:
-                    end_page = len(text_list)
-                print("start_page, end_page:", start_page, end_page)
-                cur_sec_text = ''
-                if end_page - start_page == 0:
-                    if sec_index < len(list(self.section_page_dict.keys()))-1:
-                        next_sec = list(self.section_page_dict.keys())[sec_index+1]
-                        if text_list[start_page].find(sec_name) == -1:
-                            start_i = text_list[start_page].find(sec_name.upper())
-                        else:
-                            start_i = text_list[start_page].find(sec_name)
-                        if text_list[start_page].find(next_sec) == -1:
-                            end_i = text_list[start_page].find(next_sec.upper())
-                        else:
-                            end_i = text_list[start_page].find(next_sec)                        
-                        cur_sec_text += text_list[start_page][start_i:end_i]
-                else:
-                    for page_i in range(start_page, end_page):                    
-                        if page_i == start_page:
-                            if text_list[start_page].find(sec_name) == -1:
-                                start_i = text_list[start_page].find(sec_name.upper())
-                            else:
-                                start_i = text_list[start_page].find(sec_name)
-                            cur_sec_text += text_list[page_i][start_i:]
-                        elif page_i < end_page:
-                            cur_sec_text += text_list[page_i]
-                        elif page_i == end_page:
-                            if sec_index < len(list(self.section_page_dict.keys()))-1:
-                                next_sec = list(self.section_page_dict.keys())[sec_index+1]
-                                if text_list[start_page].find(next_sec) == -1:
-                                    end_i = text_list[start_page].find(next_sec.upper())
-                                else:
-                                    end_i = text_list[start_page].find(next_sec)  
-                                cur_sec_text += text_list[page_i][:end_i]
-                section_dict[sec_name] = cur_sec_text.replace('-\n', '').replace('\n', ' ')
+            section_dict[sec_name] = self.doc_text[start:end].replace('-\n', '').replace('\n', ' ')
         return section_dict
                 
 
+class ResponseCache:
+    # chat responses stored in SQLite under sha256(model, messages, params), so rerunning
+    # the same prompts (another --file_format, a restart after a crash) costs no API calls
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_age=30 * 24 * 3600, refresh=False):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, last_used REAL)")
+        self.evict()
+
+    def key(self, model, messages, params):
+        payload = json.dumps({'model': model, 'messages': messages, 'params': params},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = None
+            if not self.refresh:
+                row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        value = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                            (key, value, len(value), now, now))
+            self.db.commit()
+
+    def evict(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # drop the least recently used entries until the cache fits again
+                for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    total -= size
+            self.db.commit()
+
+    def show_stats(self):
+        logger.info("cache hits: %d, misses: %d", self.hits, self.misses)
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+
+class PaperCache:
+    # parsed Paper output stored as gzipped JSON under sha256(pdf bytes) + PARSER_VERSION,
+    # so an unchanged PDF is loaded instead of parsed and a parser change misses automatically
+    def __init__(self, root):
+        self.root = root
+
+    def key(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha.update(chunk)
+        return '{}-v{}'.format(sha.hexdigest(), PARSER_VERSION)
+
+    def _file_name(self, key):
+        return os.path.join(self.root, key[:2], key + '.json.gz')
+
+    def load(self, path, key):
+        file_name = self._file_name(key)
+        if not os.path.exists(file_name):
+            return None
+        try:
+            with gzip.open(file_name, 'rt', encoding='utf-8') as file:
+                return Paper.from_dict(path, json.load(file))
+        except Exception as e:
+            logger.warning("paper_cache_error: %s", e)
+            return None
+
+    def save(self, key, paper):
+        file_name = self._file_name(key)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with gzip.open(file_name + '.tmp', 'wt', encoding='utf-8') as file:
+            json.dump(paper.to_dict(), file, ensure_ascii=False)
+        os.replace(file_name + '.tmp', file_name)
+
+    def get_paper(self, path):
+        key = self.key(path)
+        paper = self.load(path, key)
+        if paper is None:
+            import fitz
+            paper = Paper(path=path)
+            # stored with the parse, so a cached paper never scans for its figure again
+            with fitz.open(path) as pdf:
+                paper.largest_image = paper.find_largest_image(pdf)
+            self.save(key, paper)
+        else:
+            logger.debug("paper_cache_hit: %s", path)
+        return paper
+
+
+def init_parse_worker():
+    # a forked worker inherits the open --trace_file; its spans reach the file through the parent only
+    tracer.trace_file = None
+
+
+def parse_paper_file(path, cache_root=None):
+    # runs in a worker process: only the plain parsed data goes back, never the fitz document.
+    # The spans of the worker's tracer go back too, so the parent can record them; the worker
+    # forgets them, as a pool shared by a --serve process lives for many papers
+    first_span = len(tracer.spans)
+    try:
+        with tracer.span('parse', paper=path):
+            if cache_root:
+                paper = PaperCache(cache_root).get_paper(path)
+            else:
+                paper = Paper(path=path)
+        return path, paper.to_dict(), None, tracer.spans[first_span:]
+    except Exception as e:
+        return path, None, repr(e), tracer.spans[first_span:]
+    finally:
+        del tracer.spans[first_span:]
+
+
+def parse_papers(paths, workers=1, cache_root=None, executor=None):
+    paper_list = []
+    if workers > 1 or executor is not None:
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=init_parse_worker))
+            for path, data, error, spans in executor.map(parse_paper_file, paths, [cache_root] * len(paths)):
+                tracer.adopt(spans)
+                if error is not None:
+                    logger.error("parse_error: %s %s", path, error)
+                    continue
+                paper_list.append(Paper.from_dict(path, data))
+        return paper_list
+    load_paper = PaperCache(cache_root).get_paper if cache_root else Paper
+    for path in paths:
+        try:
+            with tracer.span('parse', paper=path):
+                paper_list.append(load_paper(path=path))
+        except Exception as e:
+            logger.error("parse_error: %s %r", path, e)
+    return paper_list
+
+
+class KeywordFilter:
+    # every filter key in one compiled regex; an abstract passes when all keys occur in it
+    def __init__(self, filter_keys):
+        keys = sorted({key.lower() for key in filter_keys.split(" ") if key}, key=len, reverse=True)
+        # a key contained in a longer key is found whenever the longer one is
+        self.keys = [key for index, key in enumerate(keys) if not any(key in longer for longer in keys[:index])]
+        # the lookahead makes matches zero-width, so overlapping keys are all seen
+        self.pattern = re.compile('(?=(' + '|'.join(map(re.escape, self.keys)) + '))') if self.keys else None
+
+    def match(self, abs_text):
+        if self.pattern is None:
+            return True
+        found = set()
+        for match in self.pattern.finditer(abs_text.lower()):
+            found.add(match.group(1))
+            if len(found) == len(self.keys):
+                return True
+        return False
+
+
+def filter_results(results, keyword_filter):
+    # consumes the result stream once, printing each result and yielding the ones that match
+    for index, result in enumerate(results):
+        abs_text = result.summary.replace('-\n', '-').replace('\n', ' ')
+        logger.debug("%s %s %s", index, result.title, result.updated)
+        logger.debug("abs_text: %s", abs_text)
+        logger.debug("-"*30)
+        if keyword_filter.match(abs_text):
+            yield result
+
+
+def tokenize_words(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+class BM25Index:
+    # Okapi BM25 over a batch of abstracts. Term counts are kept as flat (document, term, count)
+    # arrays, so scoring a query is a handful of numpy operations over all documents at once
+    def __init__(self, documents, k1=1.5, b=0.75):
+        import numpy as np
+        self.vocab = {}
+        self.num_docs = len(documents)
+        doc_ids = []
+        term_ids = []
+        lengths = np.zeros(self.num_docs)
+        for doc_index, text in enumerate(documents):
+            ids = [self.vocab.setdefault(word, len(self.vocab)) for word in tokenize_words(text)]
+            lengths[doc_index] = len(ids)
+            term_ids.extend(ids)
+            doc_ids.extend([doc_index] * len(ids))
+        vocab_size = max(len(self.vocab), 1)
+        pairs = np.asarray(doc_ids, dtype=np.int64) * vocab_size + np.asarray(term_ids, dtype=np.int64)
+        pairs, self.counts = np.unique(pairs, return_counts=True)
+        self.doc_index = pairs // vocab_size
+        self.term_index = pairs % vocab_size
+        doc_freq = np.bincount(self.term_index, minlength=vocab_size)
+        self.idf = np.log(1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        self.k1 = k1
+        # per-document length normalisation of the term frequency
+        self.norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1)) if self.num_docs else lengths
+
+    def score(self, query):
+        import numpy as np
+        weights = np.zeros(max(len(self.vocab), 1))
+        for word in tokenize_words(query):
+            if word in self.vocab:
+                weights[self.vocab[word]] += 1
+        hit = weights[self.term_index] > 0
+        terms = self.term_index[hit]
+        docs = self.doc_index[hit]
+        tf = self.counts[hit]
+        contrib = weights[terms] * self.idf[terms] * tf * (self.k1 + 1) / (tf + self.norm[docs])
+        return np.bincount(docs, weights=contrib, minlength=self.num_docs)
+
+
+def rank_results(results, query, top_k=0, min_score=0.0):
+    # replaces the all-or-nothing keyword filter: every result is scored against the query and
+    # only the best ones go on to be downloaded. Ranking needs the whole batch, so this drains
+    # the search before anything is yielded
+    import numpy as np
+    results = list(results)
+    abs_texts = [result.summary.replace('-\n', '-').replace('\n', ' ') for result in results]
+    scores = BM25Index([result.title + ' ' + abs_text for result, abs_text in zip(results, abs_texts)]).score(query)
+    order = np.argsort(-scores, kind='stable')
+    order = order[scores[order] > min_score]
+    if top_k:
+        order = order[:top_k]
+    logger.info("rank: %d of %d results kept for query: %s", len(order), len(results), query)
+    for rank, index in enumerate(order):
+        logger.info("%d %.2f %s %s", rank, scores[index], results[index].title, results[index].updated)
+    for index in order:
+        yield results[index]
+
+
+class Checkpoint:
+    # per-query record of arXiv entries already handled, used by --watch. Entry ids carry
+    # the version (.../2301.00001v2), so a new version counts as a new entry
+    def __init__(self, path):
+        self.path = path
+        self.last_updated = None
+        self.seen = {}
+        self.pending = {}
+        self.wanted = set()
+        self.reached = False
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                data = json.load(file)
+            self.last_updated = data['last_updated']
+            self.seen = data['seen']
+
+    def unseen(self, results, stop_early=False, max_results=None):
+        # reached is set when the scan got down to the watermark or to the end of the search; a scan
+        # cut off by max_results before that leaves a gap, and the watermark must not pass over it
+        count = 0
+        for result in results:
+            count += 1
+            updated = result.updated.isoformat()
+            if stop_early and self.last_updated is not None and updated < self.last_updated:
+                # sorted by update date, so everything after this was handled by an earlier run
+                logger.info("watch: reached entries older than %s, stop paging", self.last_updated)
+                self.reached = True
+                return
+            if result.entry_id in self.seen:
+                continue
+            self.pending[result.entry_id] = updated
+            yield result
+        if self.last_updated is None or max_results is None or count < max_results:
+            self.reached = True
+        elif stop_early:
+            logger.warning("watch: --max_results %d ended the scan before entries older than %s; "
+                           "the entries in between are left to a run with a larger --max_results",
+                           max_results, self.last_updated)
+
+    def track(self, results):
+        for result in results:
+            self.wanted.add(result.entry_id)
+            yield result
+
+    def commit(self, done):
+        # done: entry id -> update date of every paper the run exported, including the ones a
+        # resumed run replayed from its journal instead of getting them from unseen()
+        failed = self.wanted - set(done)
+        for entry_id, updated in done.items():
+            self.pending.setdefault(entry_id, updated)
+        for entry_id, updated in self.pending.items():
+            if entry_id not in failed:
+                self.seen[entry_id] = updated
+        if not failed and self.pending and self.reached:
+            # only move the watermark when nothing newer than it is still waiting for a retry
+            self.last_updated = max([self.last_updated or ''] + list(self.pending.values()))
+        self.pending = {}
+        self.wanted = set()
+        self.reached = False
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'last_updated': self.last_updated, 'seen': self.seen}, file)
+        os.replace(self.path + '.tmp', self.path)
+        logger.info("watch: %d new entries, %d failed, %d seen in total", len(done), len(failed), len(self.seen))
+
+
+class JournalResult:
+    # the fields of an arxiv.Result the pipeline reads, as the run journal keeps them
+    def __init__(self, data):
+        self.entry_id = data['entry_id']
+        self.title = data['title']
+        self.pdf_url = data['pdf_url']
+        self.summary = data['summary']
+        self.authors = data['authors']
+
+    @staticmethod
+    def to_dict(result):
+        return {'entry_id': result.entry_id, 'title': result.title, 'pdf_url': result.pdf_url,
+                'summary': result.summary, 'authors': [str(aut) for aut in result.authors],
+                'updated': result.updated.isoformat()}
+
+
+class RunJournal:
+    # append-only JSONL record of one batch run: its options, its papers in order and every stage
+    # each paper finished (downloaded, parsed, summary, method, conclusion, exported) or failed at.
+    # Every line is flushed when written and fsynced every sync_every lines or sync_seconds, so a
+    # crash loses at most the last stages. --resume replays the file and goes on appending to it.
+    # A run that exports every paper has nothing to resume and removes its journal when it ends
+    def __init__(self, path, sync_every=32, sync_seconds=1.0):
+        self.path = path
+        self.run_id = os.path.basename(path)[:-len('.jsonl')]
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.info = {}
+        self.papers = {}
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.synced_at = time.time()
+        complete = True
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    complete = line.endswith('\n')
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        logger.warning("journal: skipping a damaged line of %s", path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        if not complete:
+            # the last line was cut short by a crash; start the next one on its own line
+            self.file.write('\n')
+
+    def apply(self, record):
+        event = record['event']
+        if event == 'run':
+            self.info.update({name: value for name, value in record.items() if name not in ('event', 'time')})
+            return
+        paper = self.papers.setdefault(record['paper'], {'index': len(self.papers), 'item': None,
+                                                         'stages': {}, 'error': None})
+        if event == 'queued':
+            paper.update(index=record['index'], item=record.get('item'))
+        elif event == 'stage':
+            paper['stages'][record['stage']] = record
+            paper['error'] = None
+        elif event == 'failed':
+            paper['error'] = record
+
+    def write(self, record):
+        record['time'] = time.time()
+        with self.lock:
+            self.apply(record)
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.time() - self.synced_at >= self.sync_seconds:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def note(self, **info):
+        self.write(dict(info, event='run'))
+
+    def queue(self, key, item=None):
+        # the index of the paper in the run; a paper the journal already has keeps its own
+        with self.lock:
+            paper = self.papers.get(key)
+            if paper is not None:
+                return paper['index']
+            index = len(self.papers)
+        self.write({'event': 'queued', 'paper': key, 'index': index, 'item': item})
+        return index
+
+    def record(self, key, stage, **data):
+        self.write(dict(data, event='stage', paper=key, stage=stage))
+
+    def fail(self, key, stage, error):
+        self.write({'event': 'failed', 'paper': key, 'stage': stage, 'error': error})
+
+    def stage(self, key, stage):
+        with self.lock:
+            paper = self.papers.get(key)
+            return None if paper is None else paper['stages'].get(stage)
+
+    def done(self, key):
+        return self.stage(key, 'exported') is not None
+
+    def failed(self, key):
+        with self.lock:
+            paper = self.papers.get(key)
+            return paper is not None and paper['error'] is not None and 'exported' not in paper['stages']
+
+    def items(self, failed=False):
+        # (index, key, item) of the papers not exported yet: the failed ones, or all the others
+        with self.lock:
+            papers = sorted(self.papers.items(), key=lambda item: item[1]['index'])
+        return [(paper['index'], key, paper['item']) for key, paper in papers
+                if not self.done(key) and self.failed(key) == failed]
+
+    def complete(self):
+        with self.lock:
+            papers = list(self.papers)
+        return all(self.done(key) for key in papers)
+
+    def show_stats(self):
+        with self.lock:
+            papers = list(self.papers)
+        done = sum(1 for key in papers if self.done(key))
+        failed = sum(1 for key in papers if self.failed(key))
+        if done == len(papers):
+            logger.info("run %s: %d papers, all exported", self.run_id, len(papers))
+            return
+        logger.info("run %s: %d papers, %d exported, %d failed, %d left; continue it with --resume %s",
+                    self.run_id, len(papers), done, failed, len(papers) - done - failed, self.run_id)
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+
+def prune_journals(runs_dir, max_age, keep=''):
+    # journals of runs that were never resumed are dropped after max_age seconds
+    if not os.path.isdir(runs_dir):
+        return
+    for name in os.listdir(runs_dir):
+        path = os.path.join(runs_dir, name)
+        if name.endswith('.jsonl') and path != keep and time.time() - os.path.getmtime(path) > max_age:
+            logger.info("journal: removing %s, older than %.0f days", path, max_age / 86400)
+            os.remove(path)
+
+
+class DuplicateIndex:
+    # MinHash signatures of the parsed section text with LSH band buckets, stored in SQLite so
+    # another arXiv version or a local copy of an already summarized paper is recognised across
+    # runs. A lookup only reads the buckets of its own bands, whatever the size of the archive
+    def __init__(self, path, threshold=0.8, num_perm=128, bands=16, shingle=5):
+        import numpy as np
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.threshold = threshold
+        self.bands = bands
+        self.shingle = shingle
+        rng = np.random.RandomState(1)
+        self.prime = np.uint64((1 << 61) - 1)
+        self.perm_a = rng.randint(1, 1 << 32, size=num_perm).astype(np.uint64)
+        self.perm_b = rng.randint(0, 1 << 32, size=num_perm).astype(np.uint64)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS papers ("
+                        "id INTEGER PRIMARY KEY, signature BLOB, title TEXT, url TEXT, "
+                        "export_file TEXT, summary TEXT, created REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, paper_id INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS buckets_band ON buckets (band, bucket)")
+        self.db.commit()
+
+    def signature(self, paper):
+        import numpy as np
+        text = ' '.join(value for name, value in paper.section_text_dict.items()
+                        if name not in ('title', 'paper_info'))
+        words = tokenize_words(text)
+        if not words:
+            return None
+        shingles = {' '.join(words[index:index+self.shingle])
+                    for index in range(max(len(words) - self.shingle + 1, 1))}
+        hashes = np.array([zlib.crc32(item.encode('utf-8')) for item in shingles], dtype=np.uint64)
+        # one random affine permutation per row; the wrap-around of the uint64 product is harmless here
+        permuted = (np.outer(self.perm_a, hashes) + self.perm_b[:, None]) % self.prime & np.uint64(0xffffffff)
+        return permuted.min(axis=1)
+
+    def band_buckets(self, signature):
+        import numpy as np
+        for band, rows in enumerate(np.array_split(signature, self.bands)):
+            digest = hashlib.blake2b(rows.tobytes(), digest_size=8).digest()
+            yield band, int.from_bytes(digest, 'big', signed=True)
+
+    def find(self, signature):
+        import numpy as np
+        if signature is None:
+            return None
+        with self.lock:
+            candidates = set()
+            for band, bucket in self.band_buckets(signature):
+                rows = self.db.execute("SELECT paper_id FROM buckets WHERE band = ? AND bucket = ?",
+                                       (band, bucket)).fetchall()
+                candidates.update(row[0] for row in rows)
+            best = None
+            for paper_id in candidates:
+                row = self.db.execute("SELECT signature, title, url, export_file, summary FROM papers WHERE id = ?",
+                                      (paper_id,)).fetchone()
+                similarity = float(np.mean(np.frombuffer(row[0], dtype=np.uint64) == signature))
+                if similarity >= self.threshold and (best is None or similarity > best['similarity']):
+                    best = {'similarity': similarity, 'title': row[1], 'url': row[2],
+                            'export_file': row[3], 'summary': row[4]}
+            return best
+
+    def add(self, signature, paper, export_file, summary):
+        if signature is None:
+            return
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO papers (signature, title, url, export_file, summary, created) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)",
+                                     (signature.tobytes(), paper.title, paper.url, export_file, summary, time.time()))
+            self.db.executemany("INSERT INTO buckets VALUES (?, ?, ?)",
+                                [(band, bucket, cursor.lastrowid) for band, bucket in self.band_buckets(signature)])
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class SummaryStore:
+    # every exported summary with its metadata, in SQLite with an FTS5 index over title, authors
+    # and summary text. Rows are buffered and written batch_size at a time in one transaction;
+    # get() sees the buffered rows too. A paper summarized again replaces its older row
+    def __init__(self, path, batch_size=20, flush_seconds=10.0):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.pending_since = 0.0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS summaries ("
+                        "id INTEGER PRIMARY KEY, entry_id TEXT, path TEXT, title TEXT, authors TEXT, "
+                        "query TEXT, key_word TEXT, mode TEXT, export_file TEXT, summary TEXT, "
+                        "calls INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, created REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS summaries_entry_id ON summaries (entry_id)")
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS summaries_fts USING fts5("
+                        "title, authors, summary, content='summaries', content_rowid='id', "
+                        "tokenize='porter unicode61')")
+        self.db.commit()
+
+    def get(self, entry_id):
+        if not entry_id:
+            return None
+        with self.lock:
+            for row in reversed(self.pending):
+                if row['entry_id'] == entry_id:
+                    return dict(row)
+            row = self.db.execute("SELECT title, export_file, summary, created FROM summaries "
+                                  "WHERE entry_id = ? ORDER BY id DESC LIMIT 1", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        return {'entry_id': entry_id, 'title': row[0], 'export_file': row[1], 'summary': row[2], 'created': row[3]}
+
+    def add(self, paper, summary, export_file, stats, query='', key_word=''):
+        row = {'entry_id': paper.url, 'path': paper.path, 'title': paper.title,
+               'authors': ', '.join(paper.authors), 'query': query, 'key_word': key_word,
+               'mode': stats.get('mode', ''), 'export_file': export_file, 'summary': summary,
+               'calls': stats.get('calls', 0), 'prompt_tokens': stats.get('prompt_tokens', 0),
+               'completion_tokens': stats.get('completion_tokens', 0), 'created': time.time()}
+        with self.lock:
+            if not self.pending:
+                self.pending_since = time.time()
+            self.pending.append(row)
+            if len(self.pending) >= self.batch_size or time.time() - self.pending_since >= self.flush_seconds:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            for row in self.pending:
+                if row['entry_id']:
+                    old = self.db.execute("SELECT id, title, authors, summary FROM summaries WHERE entry_id = ?",
+                                          (row['entry_id'],)).fetchall()
+                    # an external content FTS table is told which text it forgets
+                    self.db.executemany("INSERT INTO summaries_fts (summaries_fts, rowid, title, authors, summary) "
+                                        "VALUES ('delete', ?, ?, ?, ?)", old)
+                    self.db.executemany("DELETE FROM summaries WHERE id = ?", [(item[0],) for item in old])
+                cursor = self.db.execute("INSERT INTO summaries ({}) VALUES ({})".format(
+                    ', '.join(row), ', '.join('?' * len(row))), list(row.values()))
+                self.db.execute("INSERT INTO summaries_fts (rowid, title, authors, summary) VALUES (?, ?, ?, ?)",
+                                (cursor.lastrowid, row['title'], row['authors'], row['summary']))
+        self.pending = []
+
+    def search(self, text, limit=10):
+        # every word has to occur; hits are ordered by BM25 with title and author matches weighted up.
+        # Words are split on any Unicode letter or digit run and quoted, the FTS tokenizer folds them
+        match = ' '.join('"{}"'.format(word) for word in re.findall(r"\w+", text))
+        if not match:
+            return []
+        self.flush()
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT bm25(summaries_fts, 10.0, 5.0, 1.0) AS score, s.entry_id, s.path, s.title, s.authors, "
+                "s.query, s.export_file, s.created, s.prompt_tokens, s.completion_tokens, "
+                "snippet(summaries_fts, 2, '[', ']', '...', 16) "
+                "FROM summaries_fts JOIN summaries s ON s.id = summaries_fts.rowid "
+                "WHERE summaries_fts MATCH ? ORDER BY score LIMIT ?", (match, limit)).fetchall()
+        names = ('score', 'entry_id', 'path', 'title', 'authors', 'query', 'export_file', 'created',
+                 'prompt_tokens', 'completion_tokens', 'snippet')
+        return [dict(zip(names, row)) for row in rows]
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def load_encoding(model, cache_dir=''):
+    # tiktoken reads the BPE file from TIKTOKEN_CACHE_DIR before it tries to download it, so a
+    # directory filled once with --warm_tokenizer (or copied from a machine that did) works offline
+    if cache_dir and 'TIKTOKEN_CACHE_DIR' not in os.environ:
+        os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+class TokenBudget:
+    # prompts are cut on exact token boundaries of the model's own encoding. Fixed prompt
+    # templates are counted once, and section tokens are cached on the paper
+    def __init__(self, model, max_token_num, cache_dir=''):
+        self.encoding = load_encoding(model, cache_dir)
+        self.max_token_num = max_token_num
+        self.template_tokens = {}
+
+    def encode(self, text):
+        return self.encoding.encode(text, disallowed_special=())
+
+    def count_messages(self, messages):
+        # every chat message costs a few tokens of framing on top of its content
+        return sum(len(self.encode(message["content"])) + 4 for message in messages) + 3
+
+    def add_template(self, name, messages):
+        self.template_tokens[name] = self.count_messages(messages)
+
+    def section_tokens(self, paper, section_name):
+        if section_name not in paper.section_tokens:
+            text = paper.section_text_dict[section_name]
+            with tracer.span('tokenize', section=section_name, bytes=len(text)) as span:
+                paper.section_tokens[section_name] = self.encode(text)
+                span['tokens'] = len(paper.section_tokens[section_name])
+        return paper.section_tokens[section_name]
+
+    def budget(self, name, reserve):
+        return max(self.max_token_num - self.template_tokens.get(name, 0) - reserve, 0)
+
+    def split(self, tokens, size, overlap):
+        step = max(size - overlap, 1)
+        return [tokens[start:start + size] for start in range(0, max(len(tokens) - overlap, 1), step)]
+
+    def clip(self, name, parts, reserve):
+        # parts are strings or already encoded token lists, taken in order until the budget is spent
+        if isinstance(parts, str):
+            parts = [parts]
+        budget = self.budget(name, reserve)
+        tokens = []
+        for part in parts:
+            tokens.extend(self.encode(part) if isinstance(part, str) else part)
+            if len(tokens) >= budget:
+                break
+        return self.encoding.decode(tokens[:budget])
+
+
+def load_api_keys(args):
+    # --api_key (comma separated), one key per line in --api_key_file, then OPENAI_API_KEYS / OPENAI_API_KEY
+    keys = []
+    if args.api_key:
+        keys += args.api_key.split(',')
+    if args.api_key_file:
+        with open(args.api_key_file, encoding='utf-8') as file:
+            keys += [line for line in file.read().split('\n') if not line.startswith('#')]
+    keys += os.environ.get('OPENAI_API_KEYS', '').split(',')
+    keys.append(os.environ.get('OPENAI_API_KEY', ''))
+    keys = [key.strip() for key in keys]
+    keys = [key for index, key in enumerate(keys) if key and key not in keys[:index]]
+    if not keys:
+        raise ValueError("no OpenAI api key: use --api_key, --api_key_file or OPENAI_API_KEY")
+    return keys
+
+
+class TokenBucket:
+    def __init__(self, capacity, period=60.0):
+        self.period = period
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, amount):
+        return max(0.0, (min(amount, self.capacity) - self.refill()) / self.rate)
+
+
+class ApiKey:
+    def __init__(self, api_key, rpm, tpm, period=60.0):
+        self.api_key = api_key
+        self.requests = TokenBucket(rpm, period)
+        self.tokens = TokenBucket(tpm, period)
+        self.blocked_until = 0.0
+
+
+class KeyPool:
+    # every key has a requests/minute and a tokens/minute bucket. A call goes to the key with
+    # the most headroom, and waits only when no key has room left
+    def __init__(self, api_keys, rpm=3500, tpm=90000, period=60.0):
+        self.keys = [ApiKey(api_key, rpm, tpm, period) for api_key in api_keys]
+        self.lock = threading.Lock()
+
+    def _headroom(self, key, estimate):
+        return min(key.requests.refill() / key.requests.capacity,
+                   (key.tokens.refill() - estimate) / key.tokens.capacity)
+
+    def acquire(self, estimate):
+        while True:
+            with self.lock:
+                now = time.time()
+                ready = [key for key in self.keys if key.blocked_until <= now]
+                if ready:
+                    key = max(ready, key=lambda key: self._headroom(key, estimate))
+                    wait = max(key.requests.wait_time(1), key.tokens.wait_time(estimate))
+                    if wait == 0:
+                        key.requests.tokens -= 1
+                        key.tokens.tokens -= estimate
+                        return key
+                else:
+                    wait = min(key.blocked_until for key in self.keys) - now
+            time.sleep(min(max(wait, 0.01), 1.0))
+
+    def release(self, key, estimate, used_tokens, headers):
+        with self.lock:
+            key.tokens.tokens += estimate - used_tokens
+            # the server's own view of the limits wins over our estimate
+            for bucket, name in ((key.requests, 'requests'), (key.tokens, 'tokens')):
+                limit = headers.get('x-ratelimit-limit-' + name)
+                remaining = headers.get('x-ratelimit-remaining-' + name)
+                if limit:
+                    bucket.capacity = float(limit)
+                    bucket.rate = bucket.capacity / bucket.period
+                if remaining:
+                    bucket.tokens = min(bucket.tokens, float(remaining))
+
+    def penalize(self, key, retry_after):
+        with self.lock:
+            key.blocked_until = time.time() + retry_after
+            key.requests.tokens = 0
+
+
+def render_combined_summary(result):
+    # turns the JSON answer of chat_combined into the same markdown the chained prompts produce
+    try:
+        data = json.loads(result[result.index('{'):result.rindex('}') + 1])
+    except ValueError:
+        return result
+
+    def as_text(value):
+        return ", ".join(map(str, value)) if isinstance(value, list) else str(value or '')
+
+    lines = []
+    for index, (name, key) in enumerate((("Title", "title"), ("Authors", "authors"), ("Affiliation", "affiliation"),
+                                         ("Keywords", "keywords"), ("Urls", "urls")), start=1):
+        lines.append("{}. {}: {}\n".format(index, name, as_text(data.get(key))))
+    for index, (name, key) in enumerate((("Summary", "summary"), ("Methods", "methods")), start=6):
+        lines.append("{}. {}: \n".format(index, name))
+        items = data.get(key) or []
+        for item_index, item in enumerate(items if isinstance(items, list) else [items], start=1):
+            lines.append("    - ({}):{};".format(item_index, as_text(item)))
+        lines.append("")
+    conclusion = data.get("conclusion") or {}
+    if not isinstance(conclusion, dict):
+        conclusion = {"significance": conclusion}
+    lines.append("8. Conclusion: \n")
+    lines.append("    - (1):{};".format(as_text(conclusion.get("significance"))))
+    lines.append("    - (2):Innovation point: {}; Performance: {}; Workload: {};".format(
+        as_text(conclusion.get("innovation")), as_text(conclusion.get("performance")), as_text(conclusion.get("workload"))))
+    return "\n".join(lines)
+
+
+class ExportWriter:
+    # one paper's export, built like "\n".join(pieces). With stream=True the text reaches the
+    # file while it arrives, flushed at every newline or every flush_size characters
+    def __init__(self, file_name, mode='w', stream=False, echo=False, flush_size=256):
+        self.echo = echo
+        self.flush_size = flush_size
+        self.pieces = 0
+        self.buffer = []
+        self.size = 0
+        self.text = []
+        self.file = open(file_name, mode, encoding="utf-8") if stream else None
+
+    def begin(self):
+        if self.pieces:
+            self.write("\n")
+        self.pieces += 1
+
+    def append(self, piece):
+        self.begin()
+        self.write(piece)
+
+    def write(self, text):
+        self.text.append(text)
+        if self.echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        if self.file is None:
+            return
+        self.buffer.append(text)
+        self.size += len(text)
+        if '\n' in text or self.size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.file.flush()
+        self.buffer = []
+        self.size = 0
+
+    def getvalue(self):
+        return ''.join(self.text)
+
+    def mark(self):
+        self.flush()
+        return len(self.text), self.pieces, self.file.tell() if self.file is not None else 0
+
+    def rollback(self, mark):
+        # drops what was written since mark, from the text and the file; echoed text stays on stdout
+        count, self.pieces, position = mark
+        del self.text[count:]
+        self.buffer = []
+        self.size = 0
+        if self.file is not None:
+            self.file.seek(position)
+            self.file.truncate()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def retry_chat_error(exception):
+    # an invalid request, e.g. a prompt over the context length, fails the same way every time,
+    # and Ctrl-C has to stop the run rather than wait for the next attempt
+    import openai
+    return isinstance(exception, Exception) and not isinstance(exception, openai.error.InvalidRequestError)
+
+
 class Reader:
     def __init__(self, key_word, query, filter_keys, 
                  root_path='./',
                  gitee_key='',
-                 sort=arxiv.SortCriterion.SubmittedDate, user_name='defualt', args=None):
+                 sort=None, user_name='defualt', args=None):
         self.user_name = user_name 
         self.key_word = key_word 
         self.query = query 
         self.sort = sort 
         self.language = 'English'        
         self.filter_keys = filter_keys
+        self.keyword_filter = KeywordFilter(filter_keys)
+        self.rank_top_k = args.rank_top_k
+        self.rank_min_score = args.rank_min_score
         self.root_path = root_path
+        self.checkpoint = None
+        if args.watch:
+            query_key = hashlib.sha1('|'.join([query, filter_keys, str(sort)]).encode('utf-8')).hexdigest()[:16]
+            self.checkpoint = Checkpoint(os.path.join(root_path, 'cache', 'checkpoints', query_key + '.json'))
         
-        self.chat_api_list = [args.api_key]
-        self.cur_api = 0
+        self.chat_api_list = load_api_keys(args)
+        self.key_pool = KeyPool(self.chat_api_list, rpm=args.rpm, tpm=args.tpm)
         self.file_format = args.file_format        
         
+        self.downloader = PdfDownloader(max_workers=args.download_workers, per_host=args.download_per_host)
+
         self.max_token_num = 4096
-        self.encoding = tiktoken.get_encoding("gpt2")
+        self.chat_model = "gpt-3.5-turbo"
+        self.summary_prompt_token = args.summary_prompt_token
+        self.method_prompt_token = args.method_prompt_token
+        self.conclusion_prompt_token = 650
+        self.token_budget = TokenBudget(self.chat_model, self.max_token_num,
+                                        cache_dir=args.tiktoken_cache_dir or os.path.join(root_path, 'cache', 'tiktoken'))
+        self.token_budget.add_template('summary', self.summary_messages(''))
+        self.token_budget.add_template('method', self.method_messages(''))
+        self.token_budget.add_template('conclusion', self.conclusion_messages(''))
+        self.token_budget.add_template('chunk', self.chunk_messages(''))
+        self.token_budget.add_template('combined', self.combined_messages(''))
+        self.summary_mode = args.summary_mode
+        self.stream = args.stream
+        self.stream_stdout = args.stream_stdout
+        self.combined_prompt_token = 1200
+        self.paper_stats = []
+        self.stats_lock = threading.Lock()
+        self.on_paper = None
+        self.journal = None
+        self.map_reduce = args.map_reduce
+        self.chunk_overlap = args.chunk_overlap
+        self.chunk_prompt_token = 500
+        self.max_calls_per_paper = args.max_calls_per_paper
+        self.chunk_executor = ThreadPoolExecutor(max_workers=args.chunk_workers) if args.map_reduce else None
+        self.api_base = args.api_base or None
+        self.encoding = self.token_budget.encoding
+        self.cache = None
+        if not args.no_cache:
+            self.cache = ResponseCache(os.path.join(root_path, 'cache', 'responses.sqlite'),
+                                       max_bytes=args.cache_max_mb * 1024 * 1024,
+                                       max_age=args.cache_max_days * 24 * 3600,
+                                       refresh=args.refresh)
+        self.duplicates = None
+        if args.dedup:
+            self.duplicates = DuplicateIndex(os.path.join(root_path, 'cache', 'duplicates.sqlite'),
+                                             threshold=args.dedup_threshold)
+        self.store = None
+        if not args.no_store:
+            self.store = SummaryStore(args.summary_store or os.path.join(root_path, 'cache', 'summaries.sqlite'))
+        self.reuse_summaries = not args.refresh
+
+    def for_request(self, key_word='', query='', filter_keys=''):
+        # a Reader for one --serve job: its own topic and per-paper stats, sharing the tokenizer,
+        # key pool, downloader, executors and caches of this one
+        reader = copy.copy(self)
+        reader.key_word = key_word or self.key_word
+        reader.query = query or self.query
+        reader.filter_keys = filter_keys or self.filter_keys
+        reader.keyword_filter = KeywordFilter(reader.filter_keys)
+        reader.checkpoint = None
+        reader.paper_stats = []
+        reader.stats_lock = threading.Lock()
+        reader.on_paper = None
+        reader.journal = None
+        return reader
                 
     def get_arxiv(self, max_results=30):
+        import arxiv
         search = arxiv.Search(query=self.query,
                               max_results=max_results,                              
-                              sort_by=self.sort,
+                              sort_by=self.sort or arxiv.SortCriterion.SubmittedDate,
                               sort_order=arxiv.SortOrder.Descending,
                               )       
         return search
      
-    def filter_arxiv(self, max_results=30):
+    def iter_arxiv(self, max_results=30):
+        # lazily filtered search: matches are yielded while arXiv is still being paged
+        import arxiv
         search = self.get_arxiv(max_results=max_results)
-        print("all search:")
-        for index, result in enumerate(search.results()):
-            print(index, result.title, result.updated)
-            print("abs_text:", result.summary.replace('-\n', '-').replace('\n', ' '))
-            print("-"*30)
-            
-        filter_results = []   
-        filter_keys = self.filter_keys
-        
-        print("filter_keys:", self.filter_keys)
-        for index, result in enumerate(search.results()):
-            abs_text = result.summary.replace('-\n', '-').replace('\n', ' ')
-            meet_num = 0
-            for f_key in filter_keys.split(" "):
-                if f_key.lower() in abs_text.lower():
-                    meet_num += 1
-            if meet_num == len(filter_keys.split(" ")):
-                filter_results.append(result)
-
-        print("筛选后剩下的论文数量：")
-        print("filter_results:", len(filter_results))
-        print("filter_papers:")
+        logger.info("filter_keys: %s", self.filter_keys)
+        results = tracer.iterate('search', search.results(), query=self.query)
+        if self.checkpoint is not None:
+            results = self.checkpoint.unseen(results, stop_early=self.sort == arxiv.SortCriterion.LastUpdatedDate,
+                                             max_results=max_results)
+        if self.rank_top_k or self.rank_min_score:
+            results = rank_results(results, self.key_word + ' ' + self.filter_keys,
+                                   top_k=self.rank_top_k, min_score=self.rank_min_score)
+        else:
+            results = filter_results(results, self.keyword_filter)
+        if self.checkpoint is None:
+            return results
+        return self.checkpoint.track(results)
+
+    def filter_arxiv(self, max_results=30):
+        filter_results = list(self.iter_arxiv(max_results=max_results))
+        logger.info("筛选后剩下的论文数量：")
+        logger.info("filter_results: %d", len(filter_results))
+        logger.info("filter_papers:")
         for index, result in enumerate(filter_results):
-            print(index, result.title, result.updated)
+            logger.info("%s %s %s", index, result.title, result.updated)
         return filter_results
     
     def validateTitle(self, title):
@@ -296,23 +1663,28 @@ class Reader:
         new_title = re.sub(rstr, "_", title)
         return new_title
 
-    def download_pdf(self, filter_results):
+    def get_pdf_dir(self):
         date_str = str(datetime.datetime.now())[:13].replace(' ', '-')        
-        key_word = str(self.key_word.replace(':', ' '))        
         path = self.root_path  + 'pdf_files/' + self.query.replace('au: ', '').replace('title: ', '').replace('ti: ', '').replace(':', ' ')[:25] + '-' + date_str
         try:
             os.makedirs(path)
         except:
             pass
-        print("All_paper:", len(filter_results))
-        paper_list = []
+        return path
+
+    def download_pdf(self, filter_results):
+        path = self.get_pdf_dir()
+        logger.info("All_paper: %d", len(filter_results))
+        jobs = []
         for r_index, result in enumerate(filter_results):
+            title_str = self.validateTitle(result.title)
+            paper_path = os.path.join(path, title_str+'.pdf')
+            jobs.append((result, paper_path, self.downloader.submit(result.pdf_url, paper_path)))
+        paper_list = []
+        for result, paper_path, future in jobs:
             try:
-                title_str = self.validateTitle(result.title)
-                pdf_name = title_str+'.pdf'
-                self.try_download_pdf(result, path, pdf_name)
-                paper_path = os.path.join(path, pdf_name)
-                print("paper_path:", paper_path)
+                future.result()
+                logger.debug("paper_path: %s", paper_path)
                 paper = Paper(path=paper_path,
                                 url=result.entry_id,
                                 title=result.title,
@@ -322,95 +1694,233 @@ class Reader:
                 paper.parse_pdf()
                 paper_list.append(paper)
             except Exception as e:
-                print("download_error:", e)
+                logger.error("download_error: %s", e)
                 pass
         return paper_list
-    
-    @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=4, max=10),
-                    stop=tenacity.stop_after_attempt(5),
-                    reraise=True)
-    def try_download_pdf(self, result, path, pdf_name):
-        result.download_pdf(path, filename=pdf_name)
         
     def summary_with_chat(self, paper_list):
-        htmls = []
         for paper_index, paper in enumerate(paper_list):
-            text = ''
-            text += 'Title:' + paper.title
-            text += 'Url:' + paper.url
-            text += 'Abstrat:' + paper.abs
-            text += 'Paper_info:' + paper.section_text_dict['paper_info']
-            text += list(paper.section_text_dict.values())[0]
-            
-            chat_summary_text = self.chat_summary(text=text)            
+            self.summarize_paper(paper_index, paper)
+
+    @tracer.traced('summary')
+    def summarize_paper(self, paper_index, paper):
+        span = tracer.current()
+        span['paper'] = span['paper'] or paper.url or paper.path
+        stats = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        start_time = time.time()
+        file_name, mode = self.export_file_name(paper_index, paper)
+        if self.journal is not None:
+            # a paper run again from its journal rewrites the export its failed attempt began,
+            # which may hold part of a streamed answer
+            started = self.journal.stage(paper.url or paper.path, 'export')
+            if started is not None:
+                file_name, mode = started['file'], 'w'
+            else:
+                self.journal.record(paper.url or paper.path, 'export', file=file_name)
+        signature = duplicate = stored = None
+        if self.store is not None and self.reuse_summaries:
+            # the same arXiv entry was summarized before: no chat call at all
+            stored = self.store.get(paper.url)
+        if self.duplicates is not None and stored is None:
+            signature = self.duplicates.signature(paper)
+            duplicate = self.duplicates.find(signature)
+        htmls = ExportWriter(file_name, mode=mode, stream=self.stream, echo=self.stream_stdout)
+        try:
             htmls.append('## Paper:' + str(paper_index+1))
-            htmls.append('\n\n\n')            
-            htmls.append(chat_summary_text)
-            
-            method_key = ''
-            for parse_key in paper.section_text_dict.keys():
-                if 'method' in parse_key.lower() or 'approach' in parse_key.lower():
-                    method_key = parse_key
-                    break
-                
-            if method_key != '':
-                text = ''
-                method_text = ''
-                summary_text = ''
-                summary_text += "" + chat_summary_text
-                # methods                
-                method_text += paper.section_text_dict[method_key]                   
-                text = summary_text + "\n\n:\n\n" + method_text                 
-                chat_method_text = self.chat_method(text=text)
-                htmls.append(chat_method_text)
+            htmls.append('\n\n\n')
+            body_start = len(htmls.getvalue())
+            if stored is not None:
+                logger.info("stored: %s summarized before in %s", paper.url, stored['export_file'])
+                htmls.write(stored['summary'])
+            elif duplicate is not None:
+                logger.info("duplicate: %s matches %s (%.2f)", paper.title, duplicate['title'], duplicate['similarity'])
+                htmls.append('Near-duplicate of {} ({}), similarity {:.2f}. Summary reused from {}'.format(
+                    duplicate['title'], duplicate['url'], duplicate['similarity'], duplicate['export_file']))
+                htmls.write(duplicate['summary'])
+            elif self.summary_mode == 'combined':
+                self.combined_summary(paper_index, paper, stats, htmls)
             else:
-                chat_method_text = ''
-            htmls.append("\n"*4)
-            
-            conclusion_key = ''
-            for parse_key in paper.section_text_dict.keys():
-                if 'conclu' in parse_key.lower():
-                    conclusion_key = parse_key
-                    break
+                self.chain_summary(paper_index, paper, stats, htmls)
+        finally:
+            # a streamed export keeps whatever was written even if the paper fails halfway
+            htmls.close()
+        if stored is None and duplicate is None and self.duplicates is not None:
+            self.duplicates.add(signature, paper, file_name, htmls.getvalue()[body_start:])
+        if stored is not None:
+            paper_mode = 'stored'
+        elif duplicate is not None:
+            paper_mode = 'duplicate'
+        else:
+            paper_mode = self.summary_mode
+        stats.update({'paper_index': paper_index, 'title': paper.title, 'mode': paper_mode,
+                      'seconds': time.time() - start_time,
+                      'first_token': stats.get('first_token', time.time()) - start_time})
+        with self.stats_lock:
+            self.paper_stats.append(stats)
+        span.update(prompt_tokens=stats['prompt_tokens'], completion_tokens=stats['completion_tokens'],
+                    calls=stats['calls'])
+        if not self.stream:
+            self.export_to_markdown(htmls.getvalue(), file_name=file_name, mode=mode)
+        if stored is None and self.store is not None:
+            self.store.add(paper, htmls.getvalue()[body_start:], file_name, stats,
+                           query=self.query, key_word=self.key_word)
+        if self.journal is not None:
+            self.journal.record(paper.url or paper.path, 'exported', file=file_name)
+        if self.on_paper is not None:
+            self.on_paper(paper, stats, file_name, htmls.getvalue())
+        return file_name
+
+    def journal_step(self, paper, stage, out, call):
+        # a chat step the resumed run already got an answer for is replayed from its journal
+        key = paper.url or paper.path
+        done = self.journal.stage(key, stage) if self.journal is not None else None
+        if done is not None:
+            if out is not None:
+                out.append(done['text'])
+            return done['text']
+        text = call()
+        if self.journal is not None:
+            self.journal.record(key, stage, text=text)
+        return text
+
+    def chain_summary(self, paper_index, paper, stats, htmls):
+        chunk_calls = self.max_calls_per_paper - 3
+        text = ''
+        text += 'Title:' + paper.title
+        text += 'Url:' + paper.url
+        text += 'Abstrat:' + paper.abs
+        text += 'Paper_info:' + paper.section_text_dict['paper_info']
+        first_key = list(paper.section_text_dict.keys())[0]
+        text = [text, self.token_budget.section_tokens(paper, first_key)]
+        
+        chat_summary_text = self.journal_step(paper, 'summary', htmls,
+                                              lambda: self.chat_summary(text=text, stats=stats, out=htmls))
+        
+        method_key = ''
+        for parse_key in paper.section_text_dict.keys():
+            if 'method' in parse_key.lower() or 'approach' in parse_key.lower():
+                method_key = parse_key
+                break
             
-            text = ''
-            conclusion_text = ''
+        if method_key != '':
             summary_text = ''
-            summary_text += "" + chat_summary_text + "\n :\n" + chat_method_text            
-            if conclusion_key != '':
-                # conclusion                
-                conclusion_text += paper.section_text_dict[conclusion_key]                                
-                text = summary_text + "\n\n:\n\n" + conclusion_text 
-            else:
-                text = summary_text            
-            chat_conclusion_text = self.chat_conclusion(text=text)
-            htmls.append(chat_conclusion_text)
-            htmls.append("\n"*4)
-            
-            date_str = str(datetime.datetime.now())[:13].replace(' ', '-')
-            try:
-                export_path = os.path.join(self.root_path, 'export')
-                os.makedirs(export_path)
-            except:
-                pass                             
-            mode = 'w' if paper_index == 0 else 'a'
-            file_name = os.path.join(export_path, date_str+'-'+self.validateTitle(paper.title)+"."+self.file_format)
-            self.export_to_markdown("\n".join(htmls), file_name=file_name, mode=mode)
-            
-            htmls = []
+            summary_text += "" + chat_summary_text
+            # methods                
+            method_tokens = self.token_budget.section_tokens(paper, method_key)
+            if self.map_reduce:
+                method_tokens, used_calls = self.condense_tokens(summary_text + "\n\n:\n\n", method_tokens,
+                                                                 'method', self.method_prompt_token, chunk_calls, stats)
+                chunk_calls -= used_calls
+            text = [summary_text + "\n\n:\n\n", method_tokens]
+            chat_method_text = self.journal_step(paper, 'method', htmls,
+                                                 lambda: self.chat_method(text=text, stats=stats, out=htmls))
+        else:
+            chat_method_text = ''
+        htmls.append("\n"*4)
+        
+        conclusion_key = ''
+        for parse_key in paper.section_text_dict.keys():
+            if 'conclu' in parse_key.lower():
+                conclusion_key = parse_key
+                break
+        
+        summary_text = ''
+        summary_text += "" + chat_summary_text + "\n :\n" + chat_method_text            
+        if conclusion_key != '':
+            # conclusion                
+            conclusion_tokens = self.token_budget.section_tokens(paper, conclusion_key)
+            if self.map_reduce:
+                conclusion_tokens, used_calls = self.condense_tokens(summary_text + "\n\n:\n\n", conclusion_tokens,
+                                                                     'conclusion', self.conclusion_prompt_token, chunk_calls, stats)
+                chunk_calls -= used_calls
+            text = [summary_text + "\n\n:\n\n", conclusion_tokens]
+        else:
+            text = summary_text            
+        chat_conclusion_text = self.journal_step(paper, 'conclusion', htmls,
+                                                 lambda: self.chat_conclusion(text=text, stats=stats, out=htmls))
+        htmls.append("\n"*4)
+
+    def combined_summary(self, paper_index, paper, stats, htmls):
+        # one call that sees every excerpt once and answers points 1-8 as JSON
+        text = ''
+        text += 'Title:' + paper.title
+        text += 'Url:' + paper.url
+        text += 'Abstrat:' + paper.abs
+        text += 'Paper_info:' + paper.section_text_dict['paper_info']
+        keys = list(paper.section_text_dict.keys())
+        excerpt_keys = [keys[0]]
+        for words in (('method', 'approach'), ('conclu',)):
+            for parse_key in keys:
+                if any(word in parse_key.lower() for word in words):
+                    if parse_key not in excerpt_keys:
+                        excerpt_keys.append(parse_key)
+                    break
+        budget = self.token_budget.budget('combined', self.combined_prompt_token) - len(self.token_budget.encode(text))
+        share = max(budget, 0) // len(excerpt_keys)
+        parts = [text]
+        for parse_key in excerpt_keys:
+            parts.append("\n\n" + parse_key + ":\n")
+            parts.append(self.token_budget.section_tokens(paper, parse_key)[:share])
+        # the JSON answer is rendered before it is exported, so it is not streamed
+        result = self.journal_step(paper, 'summary', None, lambda: self.chat_combined(parts, stats=stats))
+        htmls.append(render_combined_summary(result))
+        htmls.append("\n"*4)
+
+    @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=4, max=10),
+                    stop=tenacity.stop_after_attempt(5),
+                    retry=tenacity.retry_if_exception(retry_chat_error),
+                    before_sleep=tracer.retry_hook('llm'),
+                    reraise=True)
+    def chat_combined(self, text, stats=None):
+        clip_text = self.token_budget.clip('combined', text, self.combined_prompt_token)
+        messages = self.combined_messages(clip_text)
+        result = self.chat_completion(messages, stats=stats)
+        logger.debug("combined_result:\n%s", result)
+        return result
+
+    def combined_messages(self, clip_text):
+        messages=[
+                {"role": "system", "content": "You are an expert researcher in the field of ["+self.key_word+"] who is excellent at summarizing papers using concise, helpful statements"},
+                {"role": "assistant", "content": "This is the title, author, link, abstract, introduction, method and conclusion of an English document. I need your help to read and summarize the following questions: "+clip_text},
+                {"role": "user", "content": """                 
+                 Answer with one JSON object and nothing else, using exactly these keys:
+                    "title": the title of the paper,
+                    "authors": all the authors' names,
+                    "affiliation": the first author's affiliation,
+                    "keywords": the keywords of this article,
+                    "urls": link to the paper and the Github code link (Github:None if not available),
+                    "summary": a list of four strings answering (1) What is the research background of this article? (2) What are the past methods? What are the problems with them? Is the approach well motivated? (3) What is the research methodology proposed in this paper? (4) On what task and what performance is achieved by the methods in this paper? Can the performance support their goals?,
+                    "methods": a list of strings, the steps of the methodological idea of this article,
+                    "conclusion": an object with "significance", "innovation", "performance" and "workload", the significance of the work and its strengths and weaknesses in those three dimensions.
+                 Be sure to use {} answers (proper nouns need to be marked in English), be as concise and academic as possible, and use the original numbers.
+                 """.format(self.language)},
+            ]
+        return messages
+
+    def export_file_name(self, paper_index, paper):
+        date_str = str(datetime.datetime.now())[:13].replace(' ', '-')
+        try:
+            export_path = os.path.join(self.root_path, 'export')
+            os.makedirs(export_path)
+        except:
+            pass                             
+        mode = 'w' if paper_index == 0 else 'a'
+        file_name = os.path.join(export_path, date_str+'-'+self.validateTitle(paper.title)+"."+self.file_format)
+        return file_name, mode
     
     @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=4, max=10),
                     stop=tenacity.stop_after_attempt(5),
+                    retry=tenacity.retry_if_exception(retry_chat_error),
+                    before_sleep=tracer.retry_hook('llm'),
                     reraise=True)
-    def chat_conclusion(self, text):
-        openai.api_key = self.chat_api_list[self.cur_api]
-        self.cur_api += 1
-        self.cur_api = 0 if self.cur_api >= len(self.chat_api_list)-1 else self.cur_api
-        conclusion_prompt_token = 650        
-        text_token = len(self.encoding.encode(text))
-        clip_text_index = int(len(text)*(self.max_token_num-conclusion_prompt_token)/text_token)
-        clip_text = text[:clip_text_index]   
-        
+    def chat_conclusion(self, text, stats=None, out=None):
+        clip_text = self.token_budget.clip('conclusion', text, self.conclusion_prompt_token)
+        messages = self.conclusion_messages(clip_text)
+        result = self.chat_completion(messages, stats=stats, out=out)
+        logger.debug("conclusion_result:\n%s", result)
+        return result            
+
+    def conclusion_messages(self, clip_text):
         messages=[
                 {"role": "system", "content": "You are a reviewer in the field of ["+self.key_word+"] and you need to critically review this article"},
                 {"role": "assistant", "content": "This is the  and  part of an English literature, where  you have already summarized, but  part, I need your help to summarize the following questions:"+clip_text},
@@ -427,30 +1937,21 @@ class Reader:
                  Be sure be as concise, helpful, and academic as possible, do not repeat the content of the previous, the value of the use of the original numbers, be sure to strictly follow the format, the corresponding content output to xxx, in accordance with \n line feed, ....... means fill in according to the actual requirements, if not, you can not write.                 
                  """.format(self.language, self.language)},
             ]
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-        )
-        result = ''
-        for choice in response.choices:
-            result += choice.message.content
-        print("conclusion_result:\n", result)
-        print("prompt_token_used:", response.usage.prompt_tokens,
-              "completion_token_used:", response.usage.completion_tokens,
-              "total_token_used:", response.usage.total_tokens)
-        print("response_time:", response.response_ms/1000.0, 's')             
-        return result            
+        return messages
     
     @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=4, max=10),
                     stop=tenacity.stop_after_attempt(5),
+                    retry=tenacity.retry_if_exception(retry_chat_error),
+                    before_sleep=tracer.retry_hook('llm'),
                     reraise=True)
-    def chat_method(self, text):
-        openai.api_key = self.chat_api_list[self.cur_api]
-        self.cur_api += 1
-        self.cur_api = 0 if self.cur_api >= len(self.chat_api_list)-1 else self.cur_api
-        text_token = len(self.encoding.encode(text))
-        clip_text_index = int(len(text)*(self.max_token_num-args.method_prompt_token)/text_token)
-        clip_text = text[:clip_text_index]        
+    def chat_method(self, text, stats=None, out=None):
+        clip_text = self.token_budget.clip('method', text, self.method_prompt_token)
+        messages = self.method_messages(clip_text)
+        result = self.chat_completion(messages, stats=stats, out=out)
+        logger.debug("method_result:\n%s", result)
+        return result
+
+    def method_messages(self, clip_text):
         messages=[
                 {"role": "system", "content": "You are a researcher in the field of ["+self.key_word+"] who is good at summarizing papers using concise statements"},  
                 {"role": "assistant", "content": "This is the  and  part of an English document, where  you have summarized, but the  part, I need your help to read and summarize the following questions."+clip_text},
@@ -470,30 +1971,21 @@ class Reader:
                  Be sure to be as concise and academic as possible, do not repeat the content of the previous, the value of the use of the original numbers, be sure to strictly follow the format, the corresponding content output to xxx, in accordance with \n line feed, ....... means fill in according to the actual requirements, if not, you can not write.                 
                  """},
             ]
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-        )
-        result = ''
-        for choice in response.choices:
-            result += choice.message.content
-        print("method_result:\n", result)
-        print("prompt_token_used:", response.usage.prompt_tokens,
-              "completion_token_used:", response.usage.completion_tokens,
-              "total_token_used:", response.usage.total_tokens)
-        print("response_time:", response.response_ms/1000.0, 's') 
-        return result
+        return messages
     
     @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=4, max=10),
                     stop=tenacity.stop_after_attempt(5),
+                    retry=tenacity.retry_if_exception(retry_chat_error),
+                    before_sleep=tracer.retry_hook('llm'),
                     reraise=True)
-    def chat_summary(self, text):
-        openai.api_key = self.chat_api_list[self.cur_api]
-        self.cur_api += 1
-        self.cur_api = 0 if self.cur_api >= len(self.chat_api_list)-1 else self.cur_api
-        text_token = len(self.encoding.encode(text))
-        clip_text_index = int(len(text)*(self.max_token_num-args.summary_prompt_token)/text_token)
-        clip_text = text[:clip_text_index]
+    def chat_summary(self, text, stats=None, out=None):
+        clip_text = self.token_budget.clip('summary', text, self.summary_prompt_token)
+        messages = self.summary_messages(clip_text)
+        result = self.chat_completion(messages, stats=stats, out=out)
+        logger.debug("summary_result:\n%s", result)
+        return result        
+
+    def summary_messages(self, clip_text):
         messages=[
                 {"role": "system", "content": "You are an expert researcher in the field of ["+self.key_word+"] who is excellent at summarizing papers using concise, helpful statements"},
                 {"role": "assistant", "content": "This is the title, author, link, abstract and introduction of an English document. I need your help to read and summarize the following questions: "+clip_text},
@@ -523,37 +2015,681 @@ class Reader:
                  Be sure to be as concise and academic as possible, do not have too much repetitive information, numerical values using the original numbers. Be sure to strictly follow the format, the corresponding content output to xxx, in accordance with \n line feed.                 
                  """},
             ]
-                
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-        )
-        result = ''
-        for choice in response.choices:
-            result += choice.message.content
-        print("summary_result:\n", result)
-        print("prompt_token_used:", response.usage.prompt_tokens,
-              "completion_token_used:", response.usage.completion_tokens,
-              "total_token_used:", response.usage.total_tokens)
-        print("response_time:", response.response_ms/1000.0, 's')                    
-        return result        
+        return messages
                         
+    def condense_tokens(self, prefix, tokens, name, reserve, max_calls, stats=None):
+        # map: summarize overlapping chunks concurrently; the caller's own chat call is the reduce step.
+        # Chunk summaries that together are still over the budget are condensed again while calls are left
+        budget = self.token_budget.budget(name, reserve) - len(self.token_budget.encode(prefix))
+        if len(tokens) <= budget:
+            return tokens, 0
+        if max_calls <= 0:
+            logger.warning("map_reduce: no calls left in --max_calls_per_paper, the %s is cut from %d to %d tokens",
+                           name, len(tokens), budget)
+            return tokens, 0
+        chunk_size = self.token_budget.budget('chunk', self.chunk_prompt_token)
+        chunks = self.token_budget.split(tokens, chunk_size, self.chunk_overlap)
+        if len(chunks) > max_calls:
+            logger.warning("map_reduce: the %s has %d chunks, only the first %d fit in --max_calls_per_paper",
+                           name, len(chunks), max_calls)
+            chunks = chunks[:max_calls]
+        texts = [self.token_budget.encoding.decode(chunk) for chunk in chunks]
+        paper = tracer.current().get('paper')
+
+        def chat_chunk(text):
+            # chunk calls run on the executor's threads, so they are labelled with the paper here
+            with tracer.paper(paper):
+                return self.chat_chunk(text, stats)
+        partials = list(self.chunk_executor.map(chat_chunk, texts))
+        text = "\n".join("Part {}: {}".format(index + 1, partial) for index, partial in enumerate(partials))
+        tokens = self.token_budget.encode(text)
+        if len(tokens) > budget:
+            condensed, used_calls = self.condense_tokens(prefix, tokens, name, reserve, max_calls - len(chunks), stats)
+            return condensed, len(chunks) + used_calls
+        return text, len(chunks)
+
+    @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=4, max=10),
+                    stop=tenacity.stop_after_attempt(5),
+                    retry=tenacity.retry_if_exception(retry_chat_error),
+                    before_sleep=tracer.retry_hook('llm'),
+                    reraise=True)
+    def chat_chunk(self, text, stats=None):
+        clip_text = self.token_budget.clip('chunk', text, self.chunk_prompt_token)
+        result = self.chat_completion(self.chunk_messages(clip_text), stats=stats)
+        logger.debug("chunk_result:\n%s", result)
+        return result
+
+    def chunk_messages(self, clip_text):
+        messages=[
+                {"role": "system", "content": "You are a researcher in the field of ["+self.key_word+"] who is good at summarizing papers using concise statements"},
+                {"role": "assistant", "content": "This is one part of a long section of an English document, I need your help to summarize it:"+clip_text},
+                {"role": "user", "content": "Summarize this part in a few concise, academic sentences. Keep every step, setting and original number that matters and do not add anything that is not in the text."},
+            ]
+        return messages
+
+    @tracer.traced('llm')
+    def chat_completion(self, messages, stats=None, out=None, **params):
+        # out, when given, is the paper's ExportWriter: the answer is appended to it, token by
+        # token with --stream
+        import openai
+        span = tracer.current()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(self.chat_model, messages, params)
+            cached = self.cache.get(cache_key)
+            span['cached'] = cached is not None
+            if cached is not None:
+                logger.debug("cache_hit: %s", cache_key[:12])
+                if out is not None:
+                    out.append(cached['result'])
+                return cached['result']
+        stream = self.stream and out is not None
+        estimate = self.token_budget.count_messages(messages) + params.get('max_tokens', 500)
+        for attempt in range(2 * len(self.key_pool.keys)):
+            api_key = self.key_pool.acquire(estimate)
+            try:
+                # the key is passed per request instead of through the process-global openai.api_key
+                requestor = openai.api_requestor.APIRequestor(key=api_key.api_key, api_base=self.api_base)
+                raw_response, _, _ = requestor.request("post", "/chat/completions",
+                                                       dict(model=self.chat_model, messages=messages, stream=stream, **params),
+                                                       stream=stream)
+                if stream:
+                    mark = out.mark()
+                    try:
+                        result, usage, headers, response_ms = self._read_stream(raw_response, messages, stats, out)
+                    except BaseException:
+                        # the retry starts the answer over, so the part that arrived must not stay in the export
+                        out.rollback(mark)
+                        raise
+                else:
+                    response = openai.util.convert_to_openai_object(raw_response, api_key.api_key)
+                    result = ''
+                    for choice in response.choices:
+                        result += choice.message.content
+                    usage = dict(response.usage)
+                    headers, response_ms = raw_response._headers, response.response_ms
+            except openai.error.RateLimitError as e:
+                retry_after = (e.headers or {}).get('retry-after')
+                self.key_pool.penalize(api_key, float(retry_after) if retry_after else 1.0)
+                logger.warning("rate_limited, switching key: %s", e)
+                span['retries'] += 1
+                continue
+            self.key_pool.release(api_key, estimate, usage['total_tokens'], headers)
+            break
+        else:
+            raise openai.error.RateLimitError("every api key is rate limited")
+        if out is not None and not stream:
+            if stats is not None:
+                stats.setdefault('first_token', time.time())
+            out.append(result)
+        span.update(prompt_tokens=usage['prompt_tokens'], completion_tokens=usage['completion_tokens'],
+                    response_ms=response_ms)
+        logger.debug("prompt_token_used: %s completion_token_used: %s total_token_used: %s",
+                     usage['prompt_tokens'], usage['completion_tokens'], usage['total_tokens'])
+        logger.debug("response_time: %s s", (response_ms or 0)/1000.0)
+        if cache_key is not None:
+            self.cache.put(cache_key, {'result': result, 'usage': usage})
+        if stats is not None:
+            with self.stats_lock:
+                stats['calls'] += 1
+                stats['prompt_tokens'] += usage['prompt_tokens']
+                stats['completion_tokens'] += usage['completion_tokens']
+        return result
+
+    def _read_stream(self, raw_chunks, messages, stats, out):
+        import openai
+        result = ''
+        headers = {}
+        response_ms = None
+        out.begin()
+        for index, raw_chunk in enumerate(raw_chunks):
+            if index == 0:
+                headers, response_ms = raw_chunk._headers, raw_chunk.response_ms
+            chunk = openai.util.convert_to_openai_object(raw_chunk)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.get('content') or ''
+            if delta:
+                if stats is not None:
+                    stats.setdefault('first_token', time.time())
+                out.write(delta)
+                result += delta
+        # streamed answers carry no usage, so it is counted locally
+        prompt_tokens = self.token_budget.count_messages(messages)
+        completion_tokens = len(self.token_budget.encode(result))
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+        return result, usage, headers, response_ms
+
     def export_to_markdown(self, text, file_name, mode='w'):
-        with open(file_name, mode, encoding="utf-8") as f:
-            f.write(text)        
+        with tracer.span('export', bytes=len(text.encode('utf-8'))):
+            with open(file_name, mode, encoding="utf-8") as f:
+                f.write(text)
+
+    def show_run_summary(self):
+        if not self.paper_stats:
+            return
+        logger.info("{:<6}{:<10}{:>7}{:>10}{:>12}{:>10}{:>8}  {}".format("paper", "mode", "calls", "prompt", "completion", "seconds", "ttft", "title"))
+        for stats in sorted(self.paper_stats, key=lambda stats: stats['paper_index']):
+            logger.info("{:<6}{:<10}{:>7}{:>10}{:>12}{:>10.2f}{:>8.2f}  {}".format(
+                stats['paper_index'] + 1, stats['mode'], stats['calls'], stats['prompt_tokens'],
+                stats['completion_tokens'], stats['seconds'], stats['first_token'], stats['title'][:60]))
+        logger.info("total prompt tokens: {}, completion tokens: {}".format(
+            sum(stats['prompt_tokens'] for stats in self.paper_stats),
+            sum(stats['completion_tokens'] for stats in self.paper_stats)))
 
     def show_info(self):        
-        print(f"Key word: {self.key_word}")
-        print(f"Query: {self.query}")
-        print(f"Sort: {self.sort}")                
+        logger.info(f"Key word: {self.key_word}")
+        logger.info(f"Query: {self.query}")
+        logger.info(f"Sort: {self.sort}")                
 
-def main(args):       
-    if args.sort == 'Relevance':
+class Pipeline:
+    # download -> parse -> summarize. Every stage has its own workers and reads from a
+    # bounded queue, so a fast stage blocks instead of running ahead of a slow one. With an
+    # executor, e.g. the one a --serve process shares between jobs, the stage workers run on it
+    # instead of on threads of their own; it needs a free thread for every one of them
+    STOP = object()
+
+    def __init__(self, reader, download_workers=4, parse_workers=1, summary_workers=1, queue_size=2,
+                 executor=None, on_error=None):
+        self.reader = reader
+        self.workers = [download_workers, parse_workers, summary_workers]
+        self.queue_size = queue_size
+        self.executor = executor
+        self.on_error = on_error
+
+    def download(self, item):
+        paper_index, result = item
+        paper_path = os.path.join(self.pdf_dir, self.reader.validateTitle(result.title)+'.pdf')
+        journal = self.reader.journal
+        if journal is not None and journal.stage(result.entry_id, 'downloaded') and os.path.exists(paper_path):
+            logger.debug("downloaded before: %s", paper_path)
+            return paper_index, result, paper_path
+        with tracer.paper(result.entry_id):
+            self.reader.downloader.fetch(result.pdf_url, paper_path)
+        logger.debug("paper_path: %s", paper_path)
+        if journal is not None:
+            journal.record(result.entry_id, 'downloaded', path=paper_path)
+        return paper_index, result, paper_path
+
+    def parse(self, item):
+        paper_index, result, paper_path = item
+        with tracer.span('parse', paper=result.entry_id):
+            paper = Paper(path=paper_path,
+                          url=result.entry_id,
+                          title=result.title,
+                          abs=result.summary.replace('-\n', '-').replace('\n', ' '),
+                          authors=[str(aut) for aut in result.authors],
+                          )
+            paper.parse_pdf()
+        if self.reader.journal is not None:
+            self.reader.journal.record(result.entry_id, 'parsed', pages=len(paper.pages))
+        return paper_index, paper
+
+    def summarize(self, item):
+        paper_index, paper = item
+        self.reader.summarize_paper(paper_index, paper)
+        return paper_index, paper
+
+    def _worker(self, name, func, in_queue, out_queue, counter):
+        while True:
+            item = in_queue.get()
+            if item is self.STOP:
+                # hand the pill to the next worker of this stage; the last one closes the next stage
+                in_queue.put(self.STOP)
+                with self.lock:
+                    counter[0] -= 1
+                    last = counter[0] == 0
+                if last:
+                    out_queue.put(self.STOP)
+                return
+            try:
+                out_queue.put(func(item))
+            except Exception as e:
+                logger.error("%s_error: %s", name, e)
+                if self.reader.journal is None and self.on_error is None:
+                    continue
+                paper = item[1]
+                key = paper.url if name == 'summary' else paper.entry_id
+                if self.reader.journal is not None:
+                    self.reader.journal.fail(key, name, repr(e))
+                if self.on_error is not None:
+                    self.on_error(key, name, repr(e))
+
+    def run(self, filter_results, pdf_dir=None):
+        return self.run_items(enumerate(filter_results), pdf_dir=pdf_dir)
+
+    def run_items(self, items, pdf_dir=None):
+        # (paper_index, result) pairs; a resumed run passes the indices and the pdf_dir of its journal
+        self.pdf_dir = pdf_dir or self.reader.get_pdf_dir()
+        self.lock = threading.Lock()
+        stages = [("download", self.download), ("parse", self.parse), ("summary", self.summarize)]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages] + [queue.Queue()]
+        threads = []
+        futures = []
+        for stage_index, ((name, func), workers) in enumerate(zip(stages, self.workers)):
+            counter = [workers]
+            for _ in range(workers):
+                args = (name, func, queues[stage_index], queues[stage_index+1], counter)
+                if self.executor is not None:
+                    futures.append(self.executor.submit(self._worker, *args))
+                    continue
+                thread = threading.Thread(target=self._worker, daemon=True, args=args)
+                thread.start()
+                threads.append(thread)
+        paper_num = 0
+        for paper_index, result in items:
+            queues[0].put((paper_index, result))
+            paper_num += 1
+        queues[0].put(self.STOP)
+        logger.info("All_paper: %d", paper_num)
+        for thread in threads:
+            thread.join()
+        for future in futures:
+            future.result()
+        done = []
+        while True:
+            item = queues[-1].get()
+            if item is self.STOP:
+                break
+            done.append(item)
+        return [paper for paper_index, paper in sorted(done, key=lambda item: item[0])]
+
+
+def get_sort(name):
+    import arxiv
+    if name == 'Relevance':
         sort = arxiv.SortCriterion.Relevance
-    elif args.sort == 'LastUpdatedDate':
+    elif name == 'LastUpdatedDate':
         sort = arxiv.SortCriterion.LastUpdatedDate
     else:
         sort = arxiv.SortCriterion.Relevance
+    return sort
+
+
+def arxiv_items(reader, journal, max_results):
+    # (paper_index, result) pairs of a run: the unfinished papers already in its journal, then, unless
+    # its search went through, the new results of the search. Failed papers are left to the retry pass
+    for paper_index, entry_id, item in journal.items():
+        yield paper_index, JournalResult(item)
+    if journal.info.get('searched'):
+        return
+    for result in reader.iter_arxiv(max_results=max_results):
+        if result.entry_id in journal.papers:
+            continue
+        yield journal.queue(result.entry_id, JournalResult.to_dict(result)), result
+    journal.note(searched=True)
+
+
+def list_pdf_paths(pdf_path):
+    paper_paths = []
+    if pdf_path.endswith(".pdf"):
+        paper_paths.append(pdf_path)
+    else:
+        for root, dirs, files in os.walk(pdf_path):
+            logger.debug("root: %s dirs: %s files: %s", root, dirs, files)
+            for filename in files:
+                if filename.endswith(".pdf"):
+                    paper_paths.append(os.path.join(root, filename))
+    return paper_paths
+
+
+def summarize_paths(reader, items, workers=1, cache_root=None, lazy=False, executor=None, on_error=None):
+    # (paper_index, pdf path) pairs of local papers. A paper that fails is logged, written to the
+    # reader's journal and passed to on_error, and the others go on
+    items = list(items)
+    journal = reader.journal
+
+    def failed(paper_path, stage, error):
+        if journal is not None:
+            journal.fail(paper_path, stage, error)
+        if on_error is not None:
+            on_error(paper_path, stage, error)
+
+    if lazy:
+        # sections are read while the paper is summarized, so parse and summarize together
+        papers = [(paper_index, paper_path, lambda paper_path=paper_path: Paper(path=paper_path, lazy=True))
+                  for paper_index, paper_path in items]
+    else:
+        parsed = {paper.path: paper for paper in parse_papers([paper_path for _, paper_path in items], workers=workers,
+                                                              cache_root=cache_root, executor=executor)}
+        logger.info("------------------paper_num: {}------------------".format(len(parsed)))
+        papers = []
+        for paper_index, paper_path in items:
+            if paper_path not in parsed:
+                failed(paper_path, 'parse', 'parse_error')
+                continue
+            logger.info("%s %s", paper_index, paper_path.split('\\')[-1])
+            if journal is not None:
+                journal.record(paper_path, 'parsed', pages=len(parsed[paper_path].pages or []))
+            papers.append((paper_index, paper_path, lambda paper=parsed[paper_path]: paper))
+    for paper_index, paper_path, load_paper in papers:
+        try:
+            with tracer.paper(paper_path), load_paper() as paper:
+                reader.summarize_paper(paper_index, paper)
+        except Exception as e:
+            logger.error("summary_error: %s %r", paper_path, e)
+            failed(paper_path, 'summary', repr(e))
+
+
+class Job:
+    # one request to the --serve API. Its events are kept, so a client streaming them late
+    # still gets them all; status goes queued -> running -> done or failed
+    def __init__(self, request):
+        self.id = uuid.uuid4().hex[:12]
+        self.request = request
+        self.status = 'queued'
+        self.error = None
+        self.papers = []
+        self.events = []
+        self.created = time.time()
+        self.started = self.finished = None
+        self.changed = threading.Condition()
+
+    def emit(self, event, **fields):
+        with self.changed:
+            fields.update(event=event, job=self.id, time=time.time())
+            self.events.append(fields)
+            self.changed.notify_all()
+
+    def start(self):
+        with self.changed:
+            self.status, self.started = 'running', time.time()
+            self.emit('started')
+
+    def finish(self, status, error=None):
+        # the status and the last event change together, so a streaming client never misses it
+        with self.changed:
+            self.status, self.error, self.finished = status, error, time.time()
+            self.emit('finished', status=status, error=error)
+
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        with self.changed:
+            return {'id': self.id, 'status': self.status, 'error': self.error, 'request': self.request,
+                    'created': self.created, 'started': self.started, 'finished': self.finished,
+                    'papers': list(self.papers)}
+
+
+class SummaryService:
+    # --serve: one Reader is built at start-up and its tokenizer, key pool, downloader, chunk
+    # executor and caches serve every job, so a job only pays for parsing and chat calls.
+    # Jobs wait in a bounded queue for one of job_workers threads; a full queue rejects them
+    def __init__(self, args, job_workers=2, max_jobs=16, keep_jobs=1000):
+        self.args = args
+        self.reader = Reader(key_word=args.key_word,
+                             query=args.query,
+                             filter_keys=args.filter_keys,
+                             sort=args.sort,
+                             args=args)
+        self.cache_root = None if args.no_cache else os.path.join(self.reader.root_path, 'cache', 'papers')
+        # every stage worker of every running query job gets a thread of its own
+        self.pipeline_executor = ThreadPoolExecutor(
+            max_workers=job_workers * (args.download_workers + args.parse_workers + args.summary_workers))
+        self.parse_executor = None
+        if args.workers > 1:
+            self.parse_executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_parse_worker)
+        self.keep_jobs = keep_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_jobs)
+        self.threads = []
+        for _ in range(job_workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, request):
+        if not any(request.get(name) for name in ('query', 'url', 'pdf_path')):
+            raise ValueError("a job needs one of query, url or pdf_path")
+        job = Job(request)
+        with self.lock:
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            finished = [old for old in self.jobs.values() if old.done()]
+            for old in finished[:max(0, len(self.jobs) - self.keep_jobs)]:
+                del self.jobs[old.id]
+        job.emit('queued', position=self.queue.qsize())
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.start()
+            try:
+                self.run_job(job)
+                job.finish('done')
+            except Exception as e:
+                logger.error("job_error: %s %r", job.id, e)
+                job.finish('failed', repr(e))
+            if self.reader.store is not None:
+                self.reader.store.flush()
+            tracer.trim(10000)
+
+    def run_job(self, job):
+        request = job.request
+        reader = self.reader.for_request(key_word=request.get('key_word', ''), query=request.get('query', ''),
+                                         filter_keys=request.get('filter_keys', ''))
+
+        def on_paper(paper, stats, file_name, text):
+            record = {'paper_index': stats['paper_index'], 'title': paper.title, 'url': paper.url,
+                      'file': file_name, 'mode': stats['mode'], 'calls': stats['calls'],
+                      'prompt_tokens': stats['prompt_tokens'], 'completion_tokens': stats['completion_tokens'],
+                      'seconds': stats['seconds']}
+            with job.changed:
+                job.papers.append(record)
+            job.emit('paper', text=text, **record)
+
+        def on_error(paper, stage, error):
+            errors.append(error)
+            job.emit('error', paper=paper, stage=stage, error=error)
+
+        errors = []
+        paper_paths = None
+        reader.on_paper = on_paper
+        if request.get('url'):
+            pdf_dir = os.path.join(reader.root_path, 'pdf_files', 'urls')
+            os.makedirs(pdf_dir, exist_ok=True)
+            paper_path = os.path.join(pdf_dir, reader.validateTitle(request['url'].rstrip('/').split('/')[-1]))
+            if not paper_path.endswith('.pdf'):
+                paper_path += '.pdf'
+            with tracer.paper(request['url']):
+                reader.downloader.fetch(request['url'], paper_path)
+            job.emit('downloaded', path=paper_path)
+            paper_paths = [paper_path]
+        elif request.get('pdf_path'):
+            if not os.path.exists(request['pdf_path']):
+                raise FileNotFoundError(request['pdf_path'])
+            paper_paths = list_pdf_paths(request['pdf_path'])
+        else:
+            reader.sort = get_sort(request.get('sort', self.args.sort))
+            filter_results = reader.iter_arxiv(max_results=int(request.get('max_results', self.args.max_results)))
+            pipeline = Pipeline(reader,
+                                download_workers=self.args.download_workers,
+                                parse_workers=self.args.parse_workers,
+                                summary_workers=self.args.summary_workers,
+                                queue_size=self.args.queue_size,
+                                executor=self.pipeline_executor,
+                                on_error=on_error)
+            pipeline.run(filter_results)
+        if paper_paths is not None:
+            job.emit('papers', count=len(paper_paths))
+            summarize_paths(reader, enumerate(paper_paths), workers=self.args.workers, cache_root=self.cache_root,
+                            lazy=self.args.lazy, executor=self.parse_executor, on_error=on_error)
+        if errors and not job.papers:
+            raise RuntimeError("every paper failed: " + errors[0])
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.pipeline_executor.shutdown()
+        if self.parse_executor is not None:
+            self.parse_executor.shutdown()
+        if self.reader.chunk_executor is not None:
+            self.reader.chunk_executor.shutdown()
+        self.reader.downloader.close()
+        if self.reader.cache is not None:
+            self.reader.cache.close()
+        if self.reader.duplicates is not None:
+            self.reader.duplicates.close()
+        if self.reader.store is not None:
+            self.reader.store.close()
+
+
+def start_service(args, job_workers=2, max_jobs=16):
+    # the API: POST /jobs {"query"|"url"|"pdf_path", "key_word", "filter_keys", "sort", "max_results"}
+    # answers 202 with the job, or 503 when the queue is full; GET /jobs/<id> polls it and
+    # GET /jobs/<id>/events streams its events as JSON lines until it finishes. GET /metrics
+    # has the stage metrics of the latest spans
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    service = SummaryService(args, job_workers=job_workers, max_jobs=max_jobs)
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/jobs':
+                return self.send_json(404, {'error': 'not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                job = service.submit(request)
+            except queue.Full:
+                return self.send_json(503, {'error': 'job queue is full'})
+            except (ValueError, AttributeError) as e:
+                return self.send_json(400, {'error': str(e)})
+            self.send_json(202, job.to_dict())
+
+        def do_GET(self):
+            parts = [part for part in urlparse(self.path).path.split('/') if part]
+            if parts == ['health']:
+                return self.send_json(200, {'status': 'ok', 'queued': service.queue.qsize()})
+            if parts == ['jobs']:
+                return self.send_json(200, [job.to_dict() for job in service.list()])
+            if parts == ['metrics']:
+                body = tracer.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                return self.wfile.write(body)
+            job = service.get(parts[1]) if len(parts) in (2, 3) and parts[0] == 'jobs' else None
+            if job is None:
+                return self.send_json(404, {'error': 'not found'})
+            if len(parts) == 2:
+                return self.send_json(200, job.to_dict())
+            if parts[2] != 'events':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            sent = 0
+            while True:
+                with job.changed:
+                    while sent == len(job.events) and not job.done():
+                        job.changed.wait(timeout=15)
+                    events = job.events[sent:]
+                    finished = job.done()
+                for event in events:
+                    self.wfile.write((json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+                self.wfile.flush()
+                sent += len(events)
+                if finished:
+                    return
+
+        def log_message(self, format, *args):
+            logger.debug("%s " + format, self.address_string(), *args)
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    return server, service
+
+
+def serve(args):
+    server, service = start_service(args, job_workers=args.job_workers, max_jobs=args.max_jobs)
+    logger.info("serving on http://%s:%d", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.metrics_file:
+            tracer.write_prometheus(args.metrics_file)
+        tracer.close()
+
+
+def search(args):
+    store = SummaryStore(args.summary_store or os.path.join('./', 'cache', 'summaries.sqlite'))
+    start_time = time.time()
+    hits = store.search(args.text, limit=args.limit)
+    cost = time.time() - start_time
+    store.close()
+    for rank, hit in enumerate(hits):
+        if args.json:
+            print(json.dumps(dict(hit, rank=rank + 1), ensure_ascii=False))
+            continue
+        print("{}. {} ({:.2f})".format(rank + 1, hit['title'], -hit['score']))
+        print("   {}  {}".format(hit['entry_id'] or hit['path'], hit['authors'][:80]))
+        print("   {}".format(hit['export_file']))
+        print("   {}".format(' '.join(hit['snippet'].split())))
+    if not args.json:
+        print("{} hits in {:.1f} ms".format(len(hits), cost * 1000))
+
+
+def main(args):       
+    if args.command == 'search':
+        search(args)
+        return
+    tracer.open(args.trace_file)
+    if args.warm_tokenizer:
+        cache_dir = args.tiktoken_cache_dir or os.path.join('./', 'cache', 'tiktoken')
+        load_encoding("gpt-3.5-turbo", cache_dir)
+        logger.info("tokenizer cached in %s", os.environ.get('TIKTOKEN_CACHE_DIR', cache_dir))
+        return
+    if args.serve:
+        serve(args)
+        return
+
+    # every batch run keeps a journal until it has exported all its papers, so --resume can continue
+    # it where each paper stopped
+    run_id = args.resume or '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:4])
+    runs_dir = os.path.join('./', 'cache', 'runs')
+    journal_path = os.path.join(runs_dir, run_id + '.jsonl')
+    if args.resume and not os.path.exists(journal_path):
+        logger.error("resume: no journal %s", journal_path)
+        return
+    prune_journals(runs_dir, args.runs_max_days * 24 * 3600, keep=journal_path)
+    journal = RunJournal(journal_path)
+    tracer.run_id = journal.run_id
+    if journal.info:
+        # the resumed run keeps its own papers and options
+        args.url = ''
+        for name in ('pdf_path', 'query', 'key_word', 'filter_keys', 'sort', 'max_results'):
+            if name in journal.info:
+                setattr(args, name, journal.info[name])
+    logger.info("run id: %s", journal.run_id)
 
     if args.url:
         outpath = str(args.url).split('/')[-1]
@@ -561,39 +2697,73 @@ def main(args):
         args.pdf_path = outpath
         
     if args.pdf_path and os.path.exists(args.pdf_path):
+        # only shown here, so arxiv is not imported for local papers
         reader1 = Reader(key_word=args.key_word, 
                     query=args.query, 
                     filter_keys=args.filter_keys,                                    
-                    sort=sort, 
+                    sort=args.sort, 
                     args=args
                 )
         reader1.show_info()
-        paper_list = []     
-        if args.pdf_path.endswith(".pdf"):
-            paper_list.append(Paper(path=args.pdf_path))            
-        else:
-            for root, dirs, files in os.walk(args.pdf_path):
-                print("root:", root, "dirs:", dirs, 'files:', files)
-                for filename in files:
-                    if filename.endswith(".pdf"):
-                        paper_list.append(Paper(path=os.path.join(root, filename)))        
-        print("------------------paper_num: {}------------------".format(len(paper_list)))        
-        [print(paper_index, paper_name.path.split('\\')[-1]) for paper_index, paper_name in enumerate(paper_list)]
-        reader1.summary_with_chat(paper_list=paper_list)
+        reader1.journal = journal
+        journal.note(pdf_path=args.pdf_path, key_word=args.key_word, query=args.query, filter_keys=args.filter_keys)
+        cache_root = None if args.no_cache else os.path.join(reader1.root_path, 'cache', 'papers')
+        for paper_path in list_pdf_paths(args.pdf_path):
+            journal.queue(paper_path)
+        items = [(paper_index, paper_path) for paper_index, paper_path, _ in journal.items()]
+        summarize_paths(reader1, items, workers=args.workers, cache_root=cache_root, lazy=args.lazy)
+        for retry_pass in range(args.retry_passes):
+            items = [(paper_index, paper_path) for paper_index, paper_path, _ in journal.items(failed=True)]
+            if not items:
+                break
+            logger.info("retry pass %d: %d failed papers", retry_pass + 1, len(items))
+            summarize_paths(reader1, items, workers=args.workers, cache_root=cache_root, lazy=args.lazy)
     else:
         reader1 = Reader(key_word=args.key_word, 
                 query=args.query, 
                 filter_keys=args.filter_keys,                                    
-                sort=sort, 
+                sort=get_sort(args.sort), 
                 args=args
                 )
         reader1.show_info()
-        filter_results = reader1.filter_arxiv(max_results=args.max_results)
-        paper_list = reader1.download_pdf(filter_results)
-        reader1.summary_with_chat(paper_list=paper_list)
+        reader1.journal = journal
+        # the PDFs of a resumed run are in the directory of its first start, not in a new hour-stamped one
+        journal.note(query=args.query, key_word=args.key_word, filter_keys=args.filter_keys, sort=args.sort,
+                     max_results=args.max_results, pdf_dir=journal.info.get('pdf_dir') or reader1.get_pdf_dir())
+        pipeline = Pipeline(reader1,
+                            download_workers=args.download_workers,
+                            parse_workers=args.parse_workers,
+                            summary_workers=args.summary_workers,
+                            queue_size=args.queue_size)
+        pipeline.run_items(arxiv_items(reader1, journal, args.max_results), pdf_dir=journal.info['pdf_dir'])
+        for retry_pass in range(args.retry_passes):
+            items = [(paper_index, JournalResult(item)) for paper_index, _, item in journal.items(failed=True)]
+            if not items:
+                break
+            logger.info("retry pass %d: %d failed papers", retry_pass + 1, len(items))
+            pipeline.run_items(items, pdf_dir=journal.info['pdf_dir'])
+        if reader1.checkpoint is not None:
+            reader1.checkpoint.commit({entry_id: (paper['item'] or {}).get('updated', '')
+                                       for entry_id, paper in list(journal.papers.items()) if journal.done(entry_id)})
+    journal.show_stats()
+    journal.close()
+    if journal.complete():
+        os.remove(journal.path)
+    reader1.show_run_summary()
+    tracer.show_table()
+    if args.metrics_file:
+        tracer.write_prometheus(args.metrics_file)
+    tracer.close()
+    if reader1.cache is not None:
+        reader1.cache.show_stats()
+        reader1.cache.close()
+    if reader1.duplicates is not None:
+        reader1.duplicates.close()
+    if reader1.store is not None:
+        reader1.store.close()
     
     
-if __name__ == '__main__':    
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pdf_path", type=str, default='', help="if none, the bot will download from arxiv with query")
     parser.add_argument("--url", type=str, default='', help="Url to paper pdf to download.  Does not query ArXiv")
@@ -601,14 +2771,67 @@ if __name__ == '__main__':
     parser.add_argument("--key_word", type=str, default='deep reinforcement learning', help="the key word of user research fields")
     parser.add_argument("--filter_keys", type=str, default='reinforcement learning', help="the filter key words")
     parser.add_argument("--max_results", type=int, default=2, help="the maximum number of results")
-    parser.add_argument("--sort", type=str, default="Relevance", help="another is LastUpdatedDate, and Relevance")    
+    parser.add_argument("--sort", type=str, default="Relevance", help="another is LastUpdatedDate, and Relevance")
+    parser.add_argument("--rank_top_k", "--rank-top-k", type=int, default=0, help="rank the results by BM25 against key_word and filter_keys and keep the best k instead of filtering")
+    parser.add_argument("--rank_min_score", type=float, default=0.0, help="with ranking, drop results scoring at or below this")
     parser.add_argument("--save_image", default=False, action='store_true', help="save image? It takes a minute or two to save a picture! But pretty")
     parser.add_argument("--file_format", type=str, default='md', help="Desired output format")
     parser.add_argument("--summary_prompt_token", type=int, default=1500, help="Number of tokens for content summary")
     parser.add_argument("--method_prompt_token", type=int, default=1000, help="Number of tokens for abstract summary")    
-    parser.add_argument("--api_key", type=str, required=True, help="your openai api key!")
+    parser.add_argument("--download_workers", type=int, default=8, help="number of PDFs downloaded at the same time")
+    parser.add_argument("--download_per_host", type=int, default=4, help="maximum concurrent downloads from one host")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to parse the PDFs of --pdf_path")
+    parser.add_argument("--lazy", default=False, action='store_true', help="with --pdf_path, only read the pages of the sections the summary uses")
+    parser.add_argument("--parse_workers", type=int, default=1, help="number of PDFs parsed at the same time")
+    parser.add_argument("--summary_workers", type=int, default=1, help="number of papers summarized at the same time")
+    parser.add_argument("--queue_size", type=int, default=2, help="papers allowed to wait between two pipeline stages")
+    parser.add_argument("--watch", default=False, action='store_true', help="skip arXiv entries handled by earlier runs of the same query")
+    parser.add_argument("--no_cache", "--no-cache", default=False, action='store_true', help="do not read or write the chat response and parsed paper caches")
+    parser.add_argument("--refresh", default=False, action='store_true', help="ignore cached chat responses and stored summaries but store the new ones")
+    parser.add_argument("--cache_max_mb", type=int, default=256, help="size limit of the chat response cache")
+    parser.add_argument("--cache_max_days", type=int, default=30, help="cached chat responses older than this are dropped")
+    parser.add_argument("--dedup", default=False, action='store_true', help="reuse the summary of an earlier paper whose text is nearly the same, e.g. another arXiv version")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="estimated Jaccard similarity above which --dedup treats two papers as the same")
+    parser.add_argument("--summary_mode", type=str, default='chain', choices=['chain', 'combined'], help="chain: three chained calls per paper, combined: one call answering in JSON")
+    parser.add_argument("--stream", default=False, action='store_true', help="write answers to the export file while they are generated")
+    parser.add_argument("--stream_stdout", default=False, action='store_true', help="also echo the exported text to stdout as it arrives")
+    parser.add_argument("--map_reduce", default=False, action='store_true', help="summarize long method/conclusion sections chunk by chunk instead of cutting them off")
+    parser.add_argument("--chunk_overlap", type=int, default=100, help="tokens shared by neighbouring chunks in --map_reduce")
+    parser.add_argument("--chunk_workers", type=int, default=4, help="chunk summaries requested at the same time in --map_reduce")
+    parser.add_argument("--max_calls_per_paper", type=int, default=12, help="upper bound on chat calls for one paper in --map_reduce")
+    parser.add_argument("--api_base", type=str, default='', help="OpenAI compatible endpoint, e.g. a local server")
+    parser.add_argument("--api_key", type=str, default='', help="your openai api key! several keys can be separated by commas")
+    parser.add_argument("--api_key_file", type=str, default='', help="file with one openai api key per line")
+    parser.add_argument("--rpm", type=int, default=3500, help="requests per minute allowed for each api key")
+    parser.add_argument("--tpm", type=int, default=90000, help="tokens per minute allowed for each api key")
+    parser.add_argument("--tiktoken_cache_dir", type=str, default='', help="where the tokenizer file is cached, default ./cache/tiktoken; copy it to run offline")
+    parser.add_argument("--warm_tokenizer", default=False, action='store_true', help="only download the tokenizer into the cache and exit")
+    parser.add_argument("--log_level", type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="DEBUG also logs prompts, answers and parsing details")
+    parser.add_argument("--trace_file", type=str, default='', help="append one JSON line per finished span (stage, paper, seconds, bytes, pages, tokens, retries) to this file")
+    parser.add_argument("--resume", type=str, default='', help="run id of an interrupted run to continue; its journal is in ./cache/runs")
+    parser.add_argument("--runs_max_days", type=int, default=14, help="journals of unfinished runs older than this are removed")
+    parser.add_argument("--retry_passes", type=int, default=1, help="passes over the papers that failed, after the others are done")
+    parser.add_argument("--summary_store", type=str, default='', help="SQLite file every exported summary is indexed in, default ./cache/summaries.sqlite")
+    parser.add_argument("--no_store", default=False, action='store_true', help="neither index the exported summaries nor reuse the stored summary of an arXiv entry")
+    parser.add_argument("--serve", default=False, action='store_true', help="run a local HTTP/JSON service that summarizes submitted queries, urls and pdf paths")
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="address --serve listens on")
+    parser.add_argument("--port", type=int, default=8765, help="port --serve listens on")
+    parser.add_argument("--job_workers", type=int, default=2, help="jobs --serve runs at the same time")
+    parser.add_argument("--max_jobs", type=int, default=16, help="jobs --serve lets wait before it answers 503")
+    parser.add_argument("--metrics_file", type=str, default='', help="write per-stage metrics of the run to this Prometheus textfile")
+    commands = parser.add_subparsers(dest='command')
+    search_parser = commands.add_parser('search', help="full-text search of the stored summaries, best hits first")
+    search_parser.add_argument("text", type=str, help="words that must all occur in the title, authors or summary")
+    search_parser.add_argument("--limit", type=int, default=10, help="number of hits shown")
+    search_parser.add_argument("--json", default=False, action='store_true', help="one JSON line per hit")
+    return parser
+
+
+if __name__ == '__main__':    
+    parser = get_parser()
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
     start_time = time.time()
     main(args=args)    
-    print("summary time:", time.time() - start_time)
+    logger.info("summary time: %.2f", time.time() - start_time)
          